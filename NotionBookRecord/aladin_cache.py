@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from data_dir import DATA_DIR
+
+DEFAULT_CACHE_PATH = os.path.join(DATA_DIR, 'aladin_cache.sqlite3')
+
+
+class AladinCache:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, ttl_sec=7 * 24 * 60 * 60, max_entries=20000, bypass=False):
+        self.db_path = db_path
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # every process of a sharded import uses the same cache file
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS aladin_item_list ('
+                                'cache_key TEXT PRIMARY KEY, item_list TEXT NOT NULL, '
+                                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS aladin_item_list_accessed_at '
+                                'ON aladin_item_list (accessed_at)')
+        self.connection.commit()
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM aladin_item_list').fetchone()[0]
+
+    def get(self, query, version, page=1, count=True):
+        # count=False looks without counting a hit or miss, e.g. for every keystroke of a live search
+        if self.bypass:
+            return None
+
+        cache_key = build_cache_key(query, version, page)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT item_list, created_at FROM aladin_item_list WHERE cache_key = ?',
+                                          (cache_key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_sec:
+                if count:
+                    self.misses += 1
+                return None
+            self.connection.execute('UPDATE aladin_item_list SET accessed_at = ? WHERE cache_key = ?',
+                                    (now, cache_key))
+            self.connection.commit()
+            if count:
+                self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, query, version, item_list, page=1):
+        if self.bypass:
+            return
+
+        cache_key = build_cache_key(query, version, page)
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO aladin_item_list VALUES (?, ?, ?, ?)',
+                                             (cache_key, json.dumps(item_list, ensure_ascii=False), now, now))
+            if cursor.rowcount == 0:
+                self.connection.execute('UPDATE aladin_item_list SET item_list = ?, created_at = ?, accessed_at = ? '
+                                        'WHERE cache_key = ?',
+                                        (json.dumps(item_list, ensure_ascii=False), now, now, cache_key))
+            else:
+                self.entry_count += 1
+            if self.entry_count > self.max_entries:
+                self.evict_least_recently_used()
+            self.connection.commit()
+
+    def evict_least_recently_used(self):
+        # drop 10% more than needed so eviction doesn't run on every put
+        over_count = self.entry_count - self.max_entries + self.max_entries // 10
+        self.connection.execute('DELETE FROM aladin_item_list WHERE cache_key IN ('
+                                'SELECT cache_key FROM aladin_item_list ORDER BY accessed_at LIMIT ?)', (over_count,))
+        self.connection.execute('DELETE FROM aladin_item_list WHERE created_at < ?', (time.time() - self.ttl_sec,))
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM aladin_item_list').fetchone()[0]
+
+    def iterate_item_lists(self, batch_size=500):
+        # every cached item list, expired or not, a batch of rows at a time
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT cache_key, item_list FROM aladin_item_list WHERE cache_key > ? '
+                                               'ORDER BY cache_key LIMIT ?', (last_key, batch_size)).fetchall()
+            if not rows:
+                return
+            for cache_key, item_list in rows:
+                yield json.loads(item_list)
+            last_key = rows[-1][0]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM aladin_item_list')
+            self.connection.commit()
+            self.entry_count = 0
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self.entry_count}
+
+
+def build_cache_key(query, version, page=1):
+    if page == 1:
+        return f'{version}:{normalize_query(query)}'
+    return f'{version}:{page}:{normalize_query(query)}'
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
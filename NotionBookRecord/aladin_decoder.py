@@ -0,0 +1,28 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional. json.loads takes bytes as well, just slower
+    orjson = None
+
+# the only fields read from an aladin item. everything else in the response is dropped right after parsing
+ITEM_FIELDS = ('title', 'author', 'publisher', 'pubDate', 'cover', 'link', 'categoryName', 'isbn13', 'isbn')
+
+
+class AladinError(Exception):
+    pass
+
+
+def decode_item_list(raw_bytes, missing_ok=False):
+    document = orjson.loads(raw_bytes) if orjson is not None else json.loads(raw_bytes)
+    if 'item' not in document:
+        # ItemLookUp answers with errorCode instead of item when there's no such isbn
+        if missing_ok:
+            return []
+        raise AladinError(document.get('errorMessage', 'no item in aladin response'))
+    return [project_item(item) for item in document['item']]
+
+
+def project_item(item):
+    return {field: item.get(field, '') for field in ITEM_FIELDS}
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+
+# the benchmark never touches the real cache, index or endpoints
+os.environ.setdefault('BOOK_RECORD_DATA_DIR', tempfile.mkdtemp(prefix='book_record_benchmark_'))
+os.environ['ALADIN_CACHE_BYPASS'] = '1'
+
+from bulk_import import BulkBookRecord, choose_first
+from fake_server import FakeBookApiServer
+from pipeline import BookRecordEngine
+from profiles import BOOK_PROFILE
+from scheduler import build_default_scheduler
+from session_stats import SessionStats
+from tracing import tracer
+
+
+class BenchmarkBookRecord:
+    def __init__(self):
+        # same engine as the interactive script, minus the prompts
+        self.engine = BookRecordEngine(BOOK_PROFILE)
+        self.notion = self.engine.notion
+        self.stats = SessionStats()
+
+    def record_one_book(self, title):
+        with self.stats.measure('lookup'):
+            response = self.engine.request_book_info(title)
+        with self.stats.measure('parse'):
+            candidate_book_list = self.engine.trim_response_to_json(response)
+        with self.stats.measure('set_book_configuration'):
+            book = self.engine.build_book(candidate_book_list[0])
+        with self.stats.measure('trim_book_info_to_json'):
+            request_body = self.engine.trim_book_info_to_json(book)
+        with self.stats.measure('post'):
+            response = self.notion.http.post(self.notion.request_url, data=request_body,
+                                             headers=self.notion.get_request_header())
+        return 'added' if response.status_code == 200 else 'post_failed'
+
+
+def run_sequential_benchmark(book_count):
+    record = BenchmarkBookRecord()
+    started_at = time.perf_counter()
+    for i in range(book_count):
+        with record.stats.measure('end_to_end'):
+            record.stats.add_result(record.record_one_book(f'데미안 {i}'))
+    elapsed_sec = time.perf_counter() - started_at
+
+    return {'books': book_count,
+            'added': record.stats.books_added,
+            'elapsed_sec': round(elapsed_sec, 3),
+            'books_per_sec': round(book_count / elapsed_sec, 2),
+            'stages': {stage: {'count': count,
+                               'avg_ms': round(total_sec / count * 1000, 3),
+                               'max_ms': round(max_sec * 1000, 3)}
+                       for stage, (count, total_sec, max_sec) in record.stats.stage_timings.items()}}
+
+
+def run_bulk_benchmark(book_count, max_workers, notion_rate_per_sec):
+    file_path = os.path.join(os.environ['BOOK_RECORD_DATA_DIR'], 'benchmark_books.csv')
+    with open(file_path, 'w', encoding='utf8') as f:
+        f.write('title\n')
+        for i in range(book_count):
+            f.write(f'데미안 {i}\n')
+
+    scheduler = build_default_scheduler(max_workers, notion_rate_per_sec=notion_rate_per_sec,
+                                        aladin_rate_per_sec=1000, aladin_daily_quota=None)
+    started_at = time.perf_counter()
+    record = BulkBookRecord(file_path, choose_first, max_workers, use_cache=False, skip_duplicates=False,
+                            scheduler=scheduler)
+    elapsed_sec = time.perf_counter() - started_at
+
+    return {'books': book_count,
+            'workers': max_workers,
+            'notion_rate_per_sec': notion_rate_per_sec,
+            'counts': record.report.counts,
+            'retry_count': record.report.retry_count,
+            'elapsed_sec': round(elapsed_sec, 3),
+            'books_per_sec': round(book_count / elapsed_sec, 2)}
+
+
+def print_result(result):
+    sequential = result['sequential']
+    print(f'\nsequential: {sequential["books"]} books in {sequential["elapsed_sec"]} sec '
+          f'({sequential["books_per_sec"]} books/sec)')
+    for stage, timing in sequential['stages'].items():
+        print(f'   {stage:<24} avg {timing["avg_ms"]:>9.3f} ms   max {timing["max_ms"]:>9.3f} ms')
+
+    bulk = result['bulk']
+    print('\nspans of both runs:')
+    for span in result['spans']:
+        print(f'   {span["stage"]:<32} p50 {span["p50_ms"]:>9.3f} ms   p99 {span["p99_ms"]:>9.3f} ms   '
+              f'({span["count"]} times)')
+
+    print(f'\nbulk: {bulk["books"]} books with {bulk["workers"]} workers in {bulk["elapsed_sec"]} sec '
+          f'({bulk["books_per_sec"]} books/sec, {bulk["retry_count"]} retries)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the pipeline against a local fake aladin/notion server')
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--aladin-latency', type=float, default=0.05, help='seconds per aladin response')
+    parser.add_argument('--notion-latency', type=float, default=0.1, help='seconds per notion response')
+    parser.add_argument('--notion-429-every', type=int, default=0, help='answer every n-th page post with 429')
+    parser.add_argument('--notion-rate', type=float, default=3, help='notion requests per second of bulk import')
+    parser.add_argument('--output', help='save the result as json')
+    args = parser.parse_args()
+
+    fake_server = FakeBookApiServer(args.aladin_latency, args.notion_latency, args.notion_429_every,
+                                    retry_after_sec=0.2).start()
+    os.environ['ALADIN_API_URL'] = fake_server.get_url()
+    os.environ['NOTION_API_URL'] = fake_server.get_url()
+    try:
+        benchmark_result = {'sequential': run_sequential_benchmark(args.books),
+                            'bulk': run_bulk_benchmark(args.books, args.workers, args.notion_rate),
+                            'server_request_counts': fake_server.request_counts,
+                            'spans': tracer.metrics.to_dict()['histograms']}
+    finally:
+        fake_server.stop()
+
+    print_result(benchmark_result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(benchmark_result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,101 @@
+import os
+import re
+import json
+from functools import lru_cache
+
+DEFAULT_CATEGORY_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'book_category_table.json')
+UNKNOWN_CATEGORY = '알 수 없음'
+
+# ------------------------ aladin categoryName -> kyobo category ------------------------
+# table keys are either a whole path like '국내도서>어린이>만화' or a bare name like '만화'.
+# a bare name matches the second level of any root (국내도서, 외국도서, ...), as before.
+# the longest matching prefix wins, so a deeper path can override its parent
+
+category_table = {}
+
+
+def load_category_table(path=None):
+    path = path or os.environ.get('BOOK_CATEGORY_TABLE', DEFAULT_CATEGORY_TABLE_PATH)
+    with open(path, encoding='utf8') as f:
+        set_category_table(json.load(f))
+
+
+def set_category_table(table):
+    global category_table
+    compiled_table = {}
+    for category_path, kyobo_category in table.items():
+        segments = tuple(segment.strip() for segment in category_path.split('>'))
+        if len(segments) == 1:
+            segments = ('*',) + segments
+        compiled_table[segments] = kyobo_category
+    category_table = compiled_table
+    get_kyobo_category.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def get_kyobo_category(category_name):
+    segments = tuple(segment.strip() for segment in category_name.split('>'))
+    for depth in range(len(segments), 0, -1):
+        prefix = segments[:depth]
+        if prefix in category_table:
+            return category_table[prefix]
+        if depth > 1 and ('*',) + prefix[1:] in category_table:
+            return category_table[('*',) + prefix[1:]]
+    return UNKNOWN_CATEGORY
+
+
+# ------------------------ aladin author string -> contributors ------------------------
+# aladin writes 'A, B (지은이), C (그림), D (옮긴이)'. a role in parentheses belongs to every name before it
+# since the last role, so the string is read once from left to right
+
+CONTRIBUTOR_RE = re.compile(r'\s*([^,()]+?)\s*(?:\(([^()]*)\))?\s*(?:,|$)')
+
+ROLE_GROUPS = {'지은이': 'authors', '글': 'authors', '저자': 'authors', '원작': 'authors',
+               '옮긴이': 'translators', '번역': 'translators', '역': 'translators',
+               '그림': 'illustrators', '일러스트': 'illustrators',
+               '엮은이': 'editors', '편저': 'editors', '편역': 'editors', '편집': 'editors',
+               '감수': 'supervisors'}
+
+
+@lru_cache(maxsize=65536)
+def parse_contributors(author_str):
+    # returns {group: ((name, role), ...)}. tuples only, since the result is shared by the memo
+    contributors = {'authors': [], 'translators': [], 'illustrators': [], 'editors': [], 'supervisors': [],
+                    'others': []}
+    pending_names = []
+    for match in CONTRIBUTOR_RE.finditer(author_str):
+        name, role = match.group(1), match.group(2)
+        if name:
+            pending_names.append(name)
+        if role is None:
+            continue
+        role = role.strip()
+        group = ROLE_GROUPS.get(role, 'others')
+        contributors[group].extend((pending_name, role) for pending_name in pending_names)
+        pending_names = []
+
+    # names without any role are authors, like the old parser did
+    contributors['authors'].extend((name, '지은이') for name in pending_names)
+    return {group: tuple(members) for group, members in contributors.items()}
+
+
+@lru_cache(maxsize=65536)
+def parse_author_w_translator(author_str):
+    # (text for 지은이 property, text for 옮긴이 property)
+    contributors = parse_contributors(author_str)
+    author_list = [name for name, role in contributors['authors']]
+    for group in ('illustrators', 'editors', 'supervisors', 'others'):
+        author_list += [f'{name} ({role})' for name, role in contributors[group]]
+    translator_list = [name for name, role in contributors['translators']]
+
+    return ', '.join(author_list), ', '.join(translator_list) or '-'
+
+
+# ------------------------ isbn ------------------------
+
+def is_isbn(value):
+    # isbn-10 or isbn-13 without hyphens. isbn-10 may end with a check digit of x
+    return len(value) in (10, 13) and value[:-1].isdigit() and (value[-1].isdigit() or value[-1] in 'xX')
+
+
+load_category_table()
@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import unicodedata
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from data_dir import DATA_DIR
+
+DEFAULT_INDEX_PATH = os.path.join(DATA_DIR, 'book_search_index.sqlite3')
+# '(지은이)', '(옮긴이)' of aladin author strings would be shared by nearly every book
+ROLE_RE = re.compile(r'\([^()]*\)')
+# a different book scoring within this of the best one makes the best one a guess
+AMBIGUOUS_MARGIN = 0.15
+
+# ------------------------ hangul ------------------------
+# a syllable is 0xAC00 + (initial * 21 + medial) * 28 + final. spelled out as compatibility jamo,
+# so a syllable typed halfway ('데미ㅇ') or an initials only query ('ㄷㅁㅇ') is still close to '데미안'
+HANGUL_FIRST, HANGUL_LAST = 0xAC00, 0xD7A3
+INITIALS = 'ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ'
+MEDIALS = 'ㅏㅐㅑㅒㅓㅔㅕㅖㅗㅘㅙㅚㅛㅜㅝㅞㅟㅠㅡㅢㅣ'
+FINALS = ('',) + tuple('ㄱㄲㄳㄴㄵㄶㄷㄹㄺㄻㄼㄽㄾㄿㅀㅁㅂㅄㅅㅆㅇㅈㅊㅋㅌㅍㅎ')
+
+
+class BookSearchIndex:
+    # every aladin item ever fetched, searchable without a network call. items are kept in sqlite,
+    # and an inverted index of character bigrams (plus hangul initials) is built in memory at start.
+    # a search takes the items sharing the most grams with the query and ranks them with score_item
+    def __init__(self, db_path=DEFAULT_INDEX_PATH, max_items=50000):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        # item key -> item, item key -> its grams, gram -> item keys
+        self.item_by_key = {}
+        self.grams_by_key = {}
+        self.keys_by_gram = {}
+        # several processes add items at once in a sharded import
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS book_item ('
+                                'item_key TEXT PRIMARY KEY, item TEXT NOT NULL, indexed_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS book_item_indexed_at ON book_item (indexed_at)')
+        self.connection.commit()
+        for item_key, item in self.connection.execute('SELECT item_key, item FROM book_item'):
+            self.add_to_memory(item_key, json.loads(item))
+
+    def add_items(self, item_list):
+        # items of any aladin search or lookup. an item seen again replaces the old one.
+        # returns the number of items that weren't there
+        now = time.time()
+        rows = []
+        new_count = 0
+        with self.lock:
+            for item in item_list:
+                item_key = get_item_key(item)
+                if not item_key:
+                    continue
+                if item_key not in self.item_by_key:
+                    new_count += 1
+                self.remove_from_memory(item_key)
+                self.add_to_memory(item_key, item)
+                rows.append((item_key, json.dumps(item, ensure_ascii=False), now))
+            if not rows:
+                return 0
+            self.connection.executemany('INSERT OR REPLACE INTO book_item VALUES (?, ?, ?)', rows)
+            if len(self.item_by_key) > self.max_items:
+                self.evict_oldest_items()
+            self.connection.commit()
+        return new_count
+
+    def index_cached_items(self, aladin_cache):
+        # first start after the index was added. items already in the aladin cache are indexed once
+        with self.lock:
+            if self.item_by_key:
+                return 0
+        item_count = 0
+        for item_list in aladin_cache.iterate_item_lists():
+            self.add_items(item_list)
+            item_count += len(item_list)
+        return item_count
+
+    def add_to_memory(self, item_key, item):
+        grams = get_item_grams(item.get('title', ''), item.get('author', ''), item.get('publisher', ''))
+        self.item_by_key[item_key] = item
+        self.grams_by_key[item_key] = grams
+        for gram in grams:
+            self.keys_by_gram.setdefault(gram, set()).add(item_key)
+
+    def remove_from_memory(self, item_key):
+        self.item_by_key.pop(item_key, None)
+        for gram in self.grams_by_key.pop(item_key, ()):
+            item_keys = self.keys_by_gram[gram]
+            item_keys.discard(item_key)
+            if not item_keys:
+                del self.keys_by_gram[gram]
+
+    def evict_oldest_items(self):
+        # drop 10% more than needed so eviction doesn't run on every add
+        over_count = len(self.item_by_key) - self.max_items + self.max_items // 10
+        rows = self.connection.execute('SELECT item_key FROM book_item ORDER BY indexed_at LIMIT ?',
+                                       (over_count,)).fetchall()
+        for (item_key,) in rows:
+            self.remove_from_memory(item_key)
+        self.connection.executemany('DELETE FROM book_item WHERE item_key = ?', rows)
+
+    def search(self, query, limit=10, max_candidates=100):
+        # [(score, item), ...] best first
+        query_grams = get_query_grams(query)
+        if not query_grams:
+            return []
+        with self.lock:
+            hit_count_by_key = {}
+            for gram in query_grams:
+                for item_key in self.keys_by_gram.get(gram, ()):
+                    hit_count_by_key[item_key] = hit_count_by_key.get(item_key, 0) + 1
+            # only items sharing a fair part of the query are scored, the rest can't rank high anyway
+            min_hit_count = max(1, len(query_grams) // 3)
+            candidate_keys = sorted((key for key, count in hit_count_by_key.items() if count >= min_hit_count),
+                                    key=hit_count_by_key.get, reverse=True)[:max_candidates]
+            candidate_items = [self.item_by_key[key] for key in candidate_keys]
+        return rank_items(query, candidate_items)[:limit]
+
+    def get_stats(self):
+        with self.lock:
+            return {'items': len(self.item_by_key), 'grams': len(self.keys_by_gram)}
+
+
+def get_item_key(item):
+    return item.get('isbn13') or item.get('isbn') or item.get('link')
+
+
+# ------------------------ text features ------------------------
+
+@lru_cache(maxsize=65536)
+def normalize_text(text):
+    # lower case letters and digits only, so '해리 포터', '해리포터' and '해리-포터' are the same
+    text = unicodedata.normalize('NFC', text).lower()
+    return ''.join(char for char in text if char.isalnum())
+
+
+@lru_cache(maxsize=65536)
+def get_main_title(title):
+    # '데미안 - 에밀 싱클레어의 청소년 시절 이야기' -> '데미안'. editions of a book share it
+    return title.split(' - ')[0].split('(')[0].strip() or title
+
+
+@lru_cache(maxsize=65536)
+def decompose_hangul(text):
+    chars = []
+    for char in text:
+        code = ord(char)
+        if HANGUL_FIRST <= code <= HANGUL_LAST:
+            code -= HANGUL_FIRST
+            chars.append(INITIALS[code // 588] + MEDIALS[code % 588 // 28] + FINALS[code % 28])
+        else:
+            chars.append(char)
+    return ''.join(chars)
+
+
+def get_initials(text):
+    # '데미안' -> 'ㄷㅁㅇ'
+    return ''.join(INITIALS[(ord(char) - HANGUL_FIRST) // 588] for char in text
+                   if HANGUL_FIRST <= ord(char) <= HANGUL_LAST)
+
+
+def get_bigrams(text):
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def get_item_grams(title, author, publisher):
+    title_key = normalize_text(title)
+    grams = get_bigrams(title_key) | get_bigrams(get_initials(title_key))
+    for word in f'{ROLE_RE.sub(" ", author)} {publisher}'.split():
+        grams |= get_bigrams(normalize_text(word))
+    return grams
+
+
+def get_query_grams(query):
+    grams = set()
+    for word in query.split():
+        word_key = normalize_text(word)
+        # a syllable still being typed ('데미ㅇ') or initials alone are matched against the initials of titles
+        grams |= get_bigrams(word_key) | get_bigrams(get_initials(word_key) + ''.join(
+            char for char in word_key if char in INITIALS))
+    return grams
+
+
+# ------------------------ ranking ------------------------
+# score is 0 ~ 1. mostly how close the query is to the title, compared jamo by jamo so one wrong
+# syllable costs a part of it, not all. words of the query found in the author or publisher
+# are taken out of the title comparison, so '데미안 헤세' is as good a match as '데미안'
+
+def score_item(query, item):
+    title, author, publisher = item.get('title', ''), item.get('author', ''), item.get('publisher', '')
+    title_key = normalize_text(title)
+    other_key = normalize_text(f'{author} {publisher}')
+    title_words, found_count = [], 0
+    # words of punctuation alone don't count
+    query_words = [word_key for word_key in map(normalize_text, query.split()) if word_key]
+    if not query_words:
+        return 0.0
+    for word_key in query_words:
+        if word_key in title_key:
+            found_count += 1
+            title_words.append(word_key)
+        elif len(word_key) > 1 and word_key in other_key:
+            found_count += 1
+        else:
+            title_words.append(word_key)
+    if not title_words:
+        return 0.1 * found_count / len(query_words)
+
+    title_query = ''.join(title_words)
+    if all(char in INITIALS for char in title_query):
+        # initials only, like 'ㄷㅁㅇ'
+        title_similarity = SequenceMatcher(None, title_query, get_initials(title_key)).ratio()
+        return 0.9 * title_similarity + 0.1 * found_count / len(query_words)
+    query_jamo = decompose_hangul(title_query)
+    # matching only the main title costs a little, so the exact title comes first among editions
+    title_similarity = max(SequenceMatcher(None, query_jamo, decompose_hangul(title_key)).ratio(),
+                           0.98 * SequenceMatcher(None, query_jamo,
+                                                  decompose_hangul(normalize_text(get_main_title(title)))).ratio())
+    return 0.9 * title_similarity + 0.1 * found_count / len(query_words)
+
+
+def rank_items(query, item_list):
+    # [(score, item), ...] best first. ties keep the given order, which for aladin is its own relevance
+    scored_items = [(score_item(query, item), i, item) for i, item in enumerate(item_list)]
+    scored_items.sort(key=lambda scored_item: (-scored_item[0], scored_item[1]))
+    return [(score, item) for score, _, item in scored_items]
+
+
+def get_confidence(ranked_items):
+    # how sure the best candidate is the book meant. its score, lowered when a different book
+    # (not another edition with the same main title) comes within AMBIGUOUS_MARGIN of it
+    if not ranked_items:
+        return 0.0
+    best_score, best_item = ranked_items[0]
+    best_main_title = normalize_text(get_main_title(best_item.get('title', '')))
+    for score, item in ranked_items[1:]:
+        if normalize_text(get_main_title(item.get('title', ''))) != best_main_title:
+            return best_score * min(1.0, (best_score - score) / AMBIGUOUS_MARGIN)
+    return best_score
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='search books fetched from aladin before, without aladin')
+    parser.add_argument('query')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    My_Book_Search_Index = BookSearchIndex()
+    started_at = time.perf_counter()
+    search_result = My_Book_Search_Index.search(args.query, args.limit)
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    for search_score, search_item in search_result:
+        print(f'{search_score:.2f}  {search_item["title"]} / {search_item["author"]} / {search_item["publisher"]}')
+    print(f'{len(search_result)} books in {elapsed_ms:.1f} ms, confidence {get_confidence(search_result):.2f}')
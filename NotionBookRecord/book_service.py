@@ -0,0 +1,309 @@
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from aladin_decoder import AladinError
+from book_normalize import is_isbn
+from cache_prewarm import CachePrewarmer, get_prewarm_category_ids
+from clients import Aladin, CONNECTION_ERRORS
+from pipeline import BookRecordEngine
+from post_queue import PostQueue, drain_post_queue
+from profiles import BOOK_PROFILE, PROFILES
+from scheduler import build_default_scheduler, QuotaExceededError
+from tracing import tracer
+
+MAX_BODY_SIZE = 64 * 1024
+
+
+class ServiceError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BookRecordService:
+    # search, candidate listing and record creation over local http/json, for apps instead of a person at stdin.
+    # engines, connection pools, aladin cache and notion index are made once and stay warm for every request.
+    # the engine is blocking, so each request runs it on a worker thread while the event loop keeps accepting clients
+    def __init__(self, host='127.0.0.1', port=8650, max_workers=8, scheduler=None, drain_interval_sec=30,
+                 prewarm=True):
+        self.host = host
+        self.port = port
+        self.drain_interval_sec = drain_interval_sec
+        self.scheduler = scheduler or build_default_scheduler(max_workers)
+        self.aladin = Aladin()
+        self.post_queue = PostQueue()
+        self.engines = {name: BookRecordEngine(profile, aladin=self.aladin, scheduler=self.scheduler,
+                                               post_queue=self.post_queue)
+                        for name, profile in PROFILES.items()}
+        # new releases and bestsellers are pulled into the search index in the background, within a daily budget
+        self.prewarmer = None
+        if prewarm:
+            self.prewarmer = CachePrewarmer(self.aladin, self.scheduler, category_ids=get_prewarm_category_ids())
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.routes = {('GET', '/health'): self.handle_health,
+                       ('GET', '/search'): self.handle_search,
+                       ('POST', '/books'): self.handle_record,
+                       ('GET', '/queue'): self.handle_queue,
+                       ('GET', '/prewarm'): self.handle_prewarm,
+                       ('GET', '/metrics'): self.handle_metrics,
+                       ('GET', '/metrics.json'): self.handle_metrics_json}
+        self.server = None
+
+    async def start(self):
+        for name, engine in self.engines.items():
+            try:
+                print(f'{await self.run_blocking(engine.notion_index.sync)} pages synced from your notion ({name})')
+            except Exception:
+                print(f'Couldn\'t sync with your notion ({name}). Duplicate check might miss recently added books.')
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        asyncio.get_running_loop().create_task(self.drain_post_queue_periodically())
+        if self.prewarmer is not None:
+            self.prewarmer.start_in_background()
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        print(f'book record service listening on {self.get_url()}')
+        async with self.server:
+            await self.server.serve_forever()
+
+    def get_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args))
+
+    async def drain_post_queue_periodically(self):
+        # books queued after a failed post are tried again in the background
+        while True:
+            await asyncio.sleep(self.drain_interval_sec)
+            await self.run_blocking(partial(drain_post_queue, self.post_queue, self.engines.get, wait=False))
+
+    # ------------------------ http ------------------------
+
+    async def handle_connection(self, reader, writer):
+        # http/1.1 with keep-alive, so a client can send many requests over one connection
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                started_at = time.perf_counter()
+                status_code, data = await self.dispatch(method, target, body)
+                # spans nest per thread and coroutines share one, so requests are timed without a span
+                tracer.metrics.observe('service_request_duration_seconds', time.perf_counter() - started_at,
+                                       method=method, path=self.get_route_label(target), status=str(status_code))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(build_response(status_code, data, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ServiceError as e:
+            writer.write(build_response(e.status_code, {'error': str(e)}, keep_alive=False))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def get_route_label(self, target):
+        # unknown paths share one label, so a scanner can't blow up the metrics
+        path = urlparse(target).path
+        return path if any(path == route_path for route_method, route_path in self.routes) else 'other'
+
+    async def dispatch(self, method, target, body):
+        url = urlparse(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            if any(path == url.path for route_method, path in self.routes):
+                return 405, {'error': f'{method} is not allowed here'}
+            return 404, {'error': f'no such path: {url.path}'}
+
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            return await handler(query, parse_json_body(body))
+        except ServiceError as e:
+            return e.status_code, {'error': str(e)}
+        except QuotaExceededError as e:
+            return 429, {'error': str(e)}
+        except AladinError as e:
+            return 502, {'error': f'aladin: {e}'}
+        except CONNECTION_ERRORS as e:
+            # aladin or notion didn't answer
+            return 502, {'error': repr(e)}
+        except Exception as e:
+            # a bug of the service, not of aladin or notion
+            return 500, {'error': repr(e)}
+
+    # ------------------------ handlers ------------------------
+
+    async def handle_health(self, query, body):
+        return 200, {'status': 'ok', 'profiles': list(self.engines)}
+
+    async def handle_search(self, query, body):
+        # GET /search?title=...&page=1&profile=book -> candidates to choose from
+        engine = self.get_engine(query.get('profile'))
+        title = query.get('title', '').strip()
+        if not title:
+            raise ServiceError(400, 'title is required')
+        page = to_int(query.get('page', 1), 'page')
+
+        if is_isbn(title.replace('-', '')):
+            item_list = await self.run_blocking(engine.lookup_book_info_by_isbn, title)
+        else:
+            item_list = await self.run_blocking(engine.search_book_info, title, page)
+        engine.prefetch_covers(item_list)
+        candidates = [dict(item, index=i, page_id=engine.notion_index.find_duplicate(item['title'], item['link']),
+                           thumbnail=self.get_thumbnail_url(engine, item['cover']))
+                      for i, item in enumerate(item_list)]
+        return 200, {'title': title, 'page': page, 'candidates': candidates}
+
+    async def handle_record(self, query, body):
+        # POST /books {"isbn": ...} or {"title": ..., "index": 0, "page": 1}, plus optional
+        # "profile", "allow_duplicate" and "request_id". the same request_id is never posted twice
+        engine = self.get_engine(body.get('profile'))
+        item = await self.resolve_item(engine, body)
+        # the mirrored cover is waited for up to a few seconds, so it's off the event loop
+        book = await self.run_blocking(engine.build_book, item)
+        isbn = (body.get('isbn') or '').replace('-', '')
+
+        if not body.get('allow_duplicate') and not engine.notion_index.reserve(book.title, book.info_url, isbn):
+            page_id = engine.notion_index.find_duplicate(book.title, book.info_url, isbn)
+            return 409, {'result': 'duplicate', 'page_id': page_id, 'book': book._asdict()}
+
+        idempotency_key = str(body.get('request_id') or uuid.uuid4())
+        try:
+            result = await self.run_blocking(engine.post_book_through_queue, book, idempotency_key, isbn)
+        except Exception:
+            # nothing was queued, so the book can be added again
+            engine.notion_index.release(book.title, book.info_url, isbn)
+            raise
+        if result == 'post_failed':
+            engine.notion_index.release(book.title, book.info_url, isbn)
+        status_code = {'added': 201, 'queued': 202, 'post_in_flight': 202}.get(result, 502)
+        return status_code, {'result': result, 'request_id': idempotency_key, 'book': book._asdict()}
+
+    async def handle_queue(self, query, body):
+        return 200, self.post_queue.get_status_counts()
+
+    async def handle_prewarm(self, query, body):
+        if self.prewarmer is None:
+            raise ServiceError(404, 'prewarm is off')
+        return 200, await self.run_blocking(self.prewarmer.get_stats)
+
+    async def handle_metrics(self, query, body):
+        # prometheus text format
+        return 200, tracer.metrics.render_prometheus()
+
+    async def handle_metrics_json(self, query, body):
+        return 200, tracer.metrics.to_dict()
+
+    def get_thumbnail_url(self, engine, cover_url):
+        # only covers mirrored before. the rest are still downloading
+        if engine.cover_store is None:
+            return None
+        return engine.cover_store.get_thumbnail_url(cover_url)
+
+    def get_engine(self, profile_name):
+        profile_name = profile_name or BOOK_PROFILE.name
+        if profile_name not in self.engines:
+            raise ServiceError(400, f'unknown profile: {profile_name}')
+        return self.engines[profile_name]
+
+    async def resolve_item(self, engine, body):
+        isbn = (body.get('isbn') or '').replace('-', '')
+        if isbn:
+            if not is_isbn(isbn):
+                raise ServiceError(400, f'not an isbn: {isbn}')
+            item_list = await self.run_blocking(engine.lookup_book_info_by_isbn, isbn)
+            index = 0
+        else:
+            title = (body.get('title') or '').strip()
+            if not title:
+                raise ServiceError(400, 'title or isbn is required')
+            # same title and page as /search, so the candidates come from the aladin cache
+            item_list = await self.run_blocking(engine.search_book_info, title, to_int(body.get('page', 1), 'page'))
+            index = to_int(body.get('index', 0), 'index')
+        if not 0 <= index < len(item_list):
+            raise ServiceError(404, 'no such book in aladin')
+        return item_list[index]
+
+
+async def read_request(reader):
+    # (method, target, {lowercase header: value}, body) or None when the client closed the connection
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise ServiceError(400, 'bad request line')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = to_int(headers.get('content-length', 0), 'content-length')
+    if content_length > MAX_BODY_SIZE:
+        raise ServiceError(413, 'request body is too large')
+    body = await reader.readexactly(content_length) if content_length else b''
+    return method, target, headers, body
+
+
+def build_response(status_code, data, keep_alive=True):
+    # a str is sent as plain text, anything else as json
+    if isinstance(data, str):
+        body, content_type = data.encode('utf8'), 'text/plain; version=0.0.4; charset=utf-8'
+    else:
+        body, content_type = json.dumps(data, ensure_ascii=False).encode('utf8'), 'application/json; charset=utf-8'
+    head = (f'HTTP/1.1 {status_code} {HTTPStatus(status_code).phrase}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    return head.encode('latin-1') + body
+
+
+def parse_json_body(body):
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise ServiceError(400, 'body is not json')
+    if not isinstance(data, dict):
+        raise ServiceError(400, 'body must be a json object')
+    return data
+
+
+def to_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f'{name} must be a number')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve search and record creation as a local http/json api')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8650)
+    parser.add_argument('--workers', type=int, default=8, help='number of requests handled at once')
+    parser.add_argument('--no-prewarm', action='store_true', help='don\'t pull new releases and bestsellers '
+                                                                  'into the search index')
+    args = parser.parse_args()
+    My_Book_Record_Service = BookRecordService(args.host, args.port, args.workers, prewarm=not args.no_prewarm)
+    try:
+        asyncio.run(My_Book_Record_Service.serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,335 @@
+import csv
+import json
+import argparse
+import threading
+from functools import partial
+from difflib import SequenceMatcher
+from datetime import datetime
+
+from book_normalize import is_isbn
+from book_search_index import rank_items, get_confidence
+from clients import Aladin
+from notion_index import normalize_title
+from pipeline import BookRecordEngine
+from post_queue import PostQueue, drain_post_queue
+from profiles import BOOK_PROFILE, PROFILES
+from scheduler import build_default_scheduler, QuotaExceededError
+from tracing import tracer
+
+
+class BulkBookRecord:
+    def __init__(self, file_path, choose_book=None, max_workers=8, use_cache=True, skip_duplicates=True,
+                 scheduler=None, default_profile=BOOK_PROFILE, upsert=False, resume=False, post_queue=None):
+        # no prompt at all. every target book comes from file_path
+        self.aladin = Aladin()
+        self.aladin.cache.bypass = self.aladin.cache.bypass or not use_cache
+        # a title matched confidently by books fetched before isn't searched on aladin again
+        self.use_search_index = use_cache
+        self.search_index_hit_count = 0
+        self.search_index_hit_lock = threading.Lock()
+        self.choose_book = choose_book or choose_by_rank
+        self.scheduler = scheduler or build_default_scheduler(max_workers)
+        self.skip_duplicates = skip_duplicates or upsert
+        self.upsert = upsert
+        self.default_profile = default_profile
+        # resolved books wait in the post queue until notion has them. rows already handled are recorded there too,
+        # so a resumed job neither asks aladin again nor posts a book twice
+        self.post_queue = post_queue or PostQueue()
+        self.job_name = self.post_queue.start_bulk_job(file_path, resume)
+        self.resume = resume
+        # one engine per target database. they share aladin cache and the scheduler,
+        # so rows of several databases are handled in parallel under the same rate limits
+        self.engines = {}
+        self.engines_lock = threading.Lock()
+        self.report = BulkImportReport(file_path)
+        self.execute_bulk_book_record(file_path)
+
+    def execute_bulk_book_record(self, file_path):
+        # lookups and posts of different books run concurrently, each backend throttled by its own bucket
+        target_book_list = read_target_book_list(file_path)
+        if self.resume:
+            target_book_list = self.skip_handled_rows(target_book_list)
+        # the default database is synced before any row, so a failed sync isn't raised from a worker thread
+        self.get_engine(self.default_profile.name)
+        results = self.scheduler.map_unordered(self.record_target_book, target_book_list)
+        for line_num, target, result in results:
+            self.report.add_result(line_num, target, result)
+            self.report.print_progress()
+        self.flush_page_updates()
+        self.report.queue_counts = drain_post_queue(self.post_queue, self.get_engine, self.scheduler)
+
+        self.report.retry_count = self.scheduler.retry_count
+        self.report.cache_stats = dict(self.aladin.cache.get_stats(), search_index_hits=self.search_index_hit_count)
+        self.report.stage_timings = tracer.metrics.to_dict()['histograms']
+        self.report.print_summary()
+        self.report.save()
+        tracer.export()
+
+    def skip_handled_rows(self, target_book_list):
+        interrupted_count = self.post_queue.recover_in_flight()
+        self.post_queue.make_pending_due()
+        row_results = self.post_queue.get_row_results(self.job_name)
+        print(f'resuming after {len(row_results)} rows ({interrupted_count} posts were interrupted)')
+        for line_num, (target, result) in row_results.items():
+            if result not in RETRYABLE_RESULTS:
+                self.report.add_result(line_num, target, result)
+        for line_num, target in target_book_list:
+            if line_num not in row_results or row_results[line_num][1] in RETRYABLE_RESULTS:
+                yield line_num, target
+
+    def flush_page_updates(self):
+        # every staged change of one page goes out as a single PATCH at the end
+        for engine in self.engines.values():
+            updated_count, failed_count = engine.update_batch.flush()
+            self.report.page_update_counts['patched'] += updated_count
+            self.report.page_update_counts['patch_failed'] += failed_count
+
+    def get_engine(self, profile_name):
+        with self.engines_lock:
+            if profile_name not in self.engines:
+                engine = BookRecordEngine(PROFILES[profile_name], aladin=self.aladin, scheduler=self.scheduler,
+                                          post_queue=self.post_queue)
+                if self.skip_duplicates or self.resume:
+                    self.sync_notion_index(engine, profile_name)
+                self.engines[profile_name] = engine
+            return self.engines[profile_name]
+
+    def sync_notion_index(self, engine, profile_name):
+        try:
+            print(f'{engine.notion_index.sync()} pages synced from your notion ({profile_name})')
+        except Exception:
+            print(f'Couldn\'t sync with your notion ({profile_name}). Duplicate check might miss recently added books.')
+
+    def record_target_book(self, line_target):
+        line_num, target = line_target
+        result = self.resolve_and_post_target_book(target, f'{self.job_name}:{line_num}')
+        self.post_queue.record_row_result(self.job_name, line_num, target, result)
+        return line_num, target, result
+
+    def resolve_and_post_target_book(self, target, idempotency_key):
+        if not (target['isbn'] or target['title']):
+            return 'invalid'
+        profile_name = target['profile'] or self.default_profile.name
+        if profile_name not in PROFILES:
+            return 'unknown_profile'
+        engine = self.get_engine(profile_name)
+
+        try:
+            if target['isbn']:
+                # one small ItemLookUp response, mapped straight to the book without choosing
+                candidate_book_list = engine.lookup_book_info_by_isbn(target['isbn'])
+            else:
+                candidate_book_list = self.search_book_info(engine, target['title'])
+        except QuotaExceededError:
+            return 'quota_exceeded'
+        except Exception:
+            return 'lookup_failed'
+        if len(candidate_book_list) < 1:
+            return 'not_found'
+
+        chosen_book_index_num = 0 if target['isbn'] else self.choose_book(target, candidate_book_list)
+        if chosen_book_index_num is None:
+            return 'not_chosen'
+        book = engine.build_book(candidate_book_list[chosen_book_index_num])
+
+        if self.skip_duplicates and not engine.notion_index.reserve(book.title, book.info_url, target['isbn']):
+            page_id = engine.notion_index.find_duplicate(book.title, book.info_url, target['isbn'])
+            if self.upsert and page_id is not None:
+                return engine.stage_book_update(page_id, book)
+            return 'duplicate'
+        # a post that fails now stays 'queued' and is tried again with backoff when every row is handled
+        result = engine.post_book_through_queue(book, idempotency_key, target['isbn'])
+        if result == 'post_failed':
+            engine.notion_index.release(book.title, book.info_url, target['isbn'])
+        return result
+
+    def search_book_info(self, engine, title):
+        if self.use_search_index:
+            candidate_book_list = engine.search_local_book_info(title)
+            if candidate_book_list is not None:
+                with self.search_index_hit_lock:
+                    self.search_index_hit_count += 1
+                return candidate_book_list
+        return engine.search_book_info(title)
+
+
+class BulkImportReport:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.started_at = datetime.now()
+        self.counts = {}
+        self.failures = []
+        self.retry_count = 0
+        self.cache_stats = {}
+        self.page_update_counts = {'patched': 0, 'patch_failed': 0}
+        self.queue_counts = {'added': 0, 'dead': 0}
+        self.stage_timings = []
+
+    def add_result(self, line_num, target, result):
+        self.counts[result] = self.counts.get(result, 0) + 1
+        if result not in ('added', 'updated', 'unchanged', 'queued'):
+            self.failures.append({'line': line_num, 'title': target['title'], 'isbn': target['isbn'],
+                                  'profile': target['profile'], 'result': result})
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def print_progress(self, every=100):
+        if self.total() % every == 0:
+            print(f'{self.total()} books processed ({self.counts.get("added", 0)} added)')
+
+    def print_summary(self):
+        elapsed_sec = (datetime.now() - self.started_at).total_seconds()
+        print(f'\n{self.total()} books processed in {elapsed_sec:.1f} sec')
+        for result, count in sorted(self.counts.items()):
+            print(f'   {result}: {count}')
+        print(f'   retried requests: {self.retry_count}')
+        if self.counts.get('updated'):
+            print(f'   pages patched: {self.page_update_counts["patched"]}, '
+                  f'failed: {self.page_update_counts["patch_failed"]}')
+        if self.counts.get('queued'):
+            print(f'   queued posts added later: {self.queue_counts["added"]}, '
+                  f'moved to dead letters: {self.queue_counts["dead"]}')
+        if self.cache_stats:
+            print(f'   aladin cache hits: {self.cache_stats["hits"]}, misses: {self.cache_stats["misses"]}, '
+                  f'found in search index: {self.cache_stats["search_index_hits"]}')
+
+    def save(self):
+        report_path = f'{self.file_path}.report.json'
+        summary = {'file': self.file_path,
+                   'started_at': self.started_at.isoformat(),
+                   'finished_at': datetime.now().isoformat(),
+                   'total': self.total(),
+                   'counts': self.counts,
+                   'retry_count': self.retry_count,
+                   'cache_stats': self.cache_stats,
+                   'page_update_counts': self.page_update_counts,
+                   'queue_counts': self.queue_counts,
+                   'stage_timings': self.stage_timings,
+                   'failures': self.failures}
+        with open(report_path, 'w', encoding='utf8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f'report saved to {report_path}')
+
+
+# rows with these results are handled again when a job is resumed
+RETRYABLE_RESULTS = ('lookup_failed', 'quota_exceeded', 'post_in_flight')
+
+
+def read_target_book_list(file_path):
+    # yields (line number, {'title': ..., 'isbn': ..., 'profile': ...}) one by one,
+    # so a huge catalog never sits in memory
+    if file_path.endswith('.jsonl'):
+        yield from read_target_book_list_from_jsonl(file_path)
+    else:
+        yield from read_target_book_list_from_csv(file_path)
+
+
+def read_target_book_list_from_csv(file_path):
+    with open(file_path, encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        first_row = next(reader, [])
+        # lower case only to spot the header. a first row of data is kept as it is
+        header = [column.strip().lower() for column in first_row]
+        has_header = 'title' in header or 'isbn' in header
+        if not has_header and first_row:
+            # no header. the first column is title or isbn
+            yield 1, to_target_book(first_row[0])
+
+        for line_num, row in enumerate(reader, start=2):
+            if not row:
+                continue
+            if has_header:
+                yield line_num, to_target_book(**{key: value for key, value in zip(header, row)
+                                                  if key in ('title', 'isbn', 'profile')})
+            else:
+                yield line_num, to_target_book(row[0])
+
+
+def read_target_book_list_from_jsonl(file_path):
+    with open(file_path, encoding='utf8') as f:
+        for line_num, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # a broken line is reported as invalid, the rest of the file goes on
+                yield line_num, to_target_book()
+                continue
+            if isinstance(item, dict):
+                yield line_num, to_target_book(item.get('title', ''), item.get('isbn', ''), item.get('profile', ''))
+            else:
+                yield line_num, to_target_book(str(item))
+
+
+def to_target_book(title='', isbn='', profile=''):
+    # jsonl values can be numbers, like an isbn without quotes
+    title = str(title or '').strip()
+    isbn = str(isbn or '').replace('-', '').strip()
+    if not isbn and is_isbn(title.replace('-', '')):
+        # a single column might hold isbn instead of title
+        isbn, title = title.replace('-', ''), ''
+    return {'title': title, 'isbn': isbn, 'profile': str(profile or '').strip()}
+
+
+# ------------------------ auto selection ------------------------
+# chooser gets the target book and candidate list, then returns index of chosen book or None to skip
+
+def choose_first(target, candidate_book_list):
+    return 0
+
+
+def choose_best_title_match(target, candidate_book_list, min_ratio=0.6):
+    if target['isbn']:
+        for i, book in enumerate(candidate_book_list):
+            if target['isbn'] in (book.get('isbn13'), book.get('isbn')):
+                return i
+        return 0
+
+    best_index, best_ratio = None, min_ratio
+    for i, book in enumerate(candidate_book_list):
+        ratio = SequenceMatcher(None, normalize_title(target['title']), normalize_title(book['title'])).ratio()
+        if ratio > best_ratio:
+            best_index, best_ratio = i, ratio
+    return best_index
+
+
+def choose_by_rank(target, candidate_book_list, min_confidence=0.75):
+    # the best ranked candidate, if it's clearly the book meant. editions of the same title don't make it
+    # unclear, the one aladin lists first of them is taken. a close call between different books is skipped
+    if target['isbn']:
+        return choose_best_title_match(target, candidate_book_list)
+    ranked_items = rank_items(target['title'], candidate_book_list)
+    if get_confidence(ranked_items) < min_confidence:
+        return None
+    best_item = ranked_items[0][1]
+    return next(i for i, book in enumerate(candidate_book_list) if book is best_item)
+
+
+CHOOSERS = {'first': choose_first,
+            'title': choose_best_title_match,
+            'rank': choose_by_rank}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='add every book in a csv/jsonl file to your notion database')
+    parser.add_argument('file_path', help='csv(title, isbn, profile columns) or jsonl file')
+    parser.add_argument('--profile', choices=PROFILES.keys(), default=BOOK_PROFILE.name,
+                        help='target database of rows without profile')
+    parser.add_argument('--choose', choices=CHOOSERS.keys(), default='rank', help='how to pick a candidate')
+    parser.add_argument('--min-confidence', type=float, default=0.75,
+                        help='rank only. rows whose best candidate is less sure than this are skipped')
+    parser.add_argument('--workers', type=int, default=8, help='number of books handled at once')
+    parser.add_argument('--no-cache', action='store_true', help='always ask aladin, not the local cache')
+    parser.add_argument('--allow-duplicates', action='store_true', help='add books already in your notion again')
+    parser.add_argument('--upsert', action='store_true', help='update changed properties of books already there')
+    parser.add_argument('--resume', action='store_true', help='go on from where the last run of this file stopped')
+    args = parser.parse_args()
+    chooser = CHOOSERS[args.choose]
+    if args.choose == 'rank':
+        chooser = partial(choose_by_rank, min_confidence=args.min_confidence)
+    My_Bulk_Book_Record = BulkBookRecord(args.file_path, chooser, args.workers, not args.no_cache,
+                                         not args.allow_duplicates, default_profile=PROFILES[args.profile],
+                                         upsert=args.upsert, resume=args.resume)
@@ -0,0 +1,168 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import date
+
+from aladin_decoder import decode_item_list
+from clients import Aladin
+from data_dir import DATA_DIR
+from scheduler import build_default_scheduler
+from tracing import tracer
+
+DEFAULT_PREWARM_PATH = os.path.join(DATA_DIR, 'cache_prewarm.sqlite3')
+# (QueryType, CategoryId). 0 is every category
+DEFAULT_FEEDS = (('Bestseller', 0), ('ItemNewSpecial', 0), ('ItemNewAll', 0))
+
+
+class CachePrewarmer:
+    # recent releases and bestsellers are pulled from aladin ItemList feeds ahead of time into the search index
+    # and the isbn cache, so most searches at the desk are answered without a round trip to aladin.
+    # calls are counted per day against daily_budget, which keeps it from spending the quota searches need
+    def __init__(self, aladin=None, scheduler=None, feeds=DEFAULT_FEEDS, category_ids=(), pages=2, max_results=50,
+                 daily_budget=300, interval_sec=6 * 60 * 60, db_path=DEFAULT_PREWARM_PATH):
+        self.aladin = aladin or Aladin()
+        self.scheduler = scheduler
+        # a category list is the new releases of that category
+        self.feeds = tuple(feeds) + tuple(('ItemNewAll', category_id) for category_id in category_ids)
+        self.pages = pages
+        self.max_results = max_results
+        self.daily_budget = daily_budget
+        self.interval_sec = interval_sec
+        self.item_list_url = self.aladin.request_url.replace('ItemSearch.aspx', 'ItemList.aspx')
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prewarm_usage ('
+                                'day TEXT PRIMARY KEY, calls INTEGER NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prewarm_run ('
+                                'started_at REAL NOT NULL, finished_at REAL NOT NULL, calls INTEGER NOT NULL, '
+                                'items INTEGER NOT NULL, new_items INTEGER NOT NULL, error TEXT)')
+        self.connection.commit()
+
+    def run(self):
+        # every page of every feed once, as far as the budget goes. returns a summary of the run
+        started_at = time.time()
+        summary = {'calls': 0, 'items': 0, 'new_items': 0, 'error': None}
+        with tracer.span('prewarm_cache', feeds=len(self.feeds)) as span:
+            try:
+                self.pull_feeds(summary)
+            except Exception as e:
+                span.status = 'error'
+                summary['error'] = repr(e)
+            span.set(calls=summary['calls'], new_items=summary['new_items'])
+        tracer.metrics.count('prewarm_aladin_calls_total', summary['calls'])
+        with self.lock:
+            self.connection.execute('INSERT INTO prewarm_run VALUES (?, ?, ?, ?, ?, ?)',
+                                    (started_at, time.time(), summary['calls'], summary['items'],
+                                     summary['new_items'], summary['error']))
+            self.connection.commit()
+        return summary
+
+    def pull_feeds(self, summary):
+        for query_type, category_id in self.feeds:
+            for page in range(1, self.pages + 1):
+                if self.stop_event.is_set() or not self.use_budget():
+                    return
+                summary['calls'] += 1
+                item_list = self.request_item_list(query_type, category_id, page)
+                summary['items'] += len(item_list)
+                summary['new_items'] += self.store_items(item_list)
+                if len(item_list) < self.max_results:
+                    # the feed has no more pages
+                    break
+
+    def request_item_list(self, query_type, category_id, page):
+        params = {'TTBKey': self.aladin.ttb_key, 'QueryType': query_type, 'CategoryId': category_id,
+                  'SearchTarget': 'Book', 'MaxResults': self.max_results, 'Start': page, 'Output': 'JS',
+                  'Version': self.aladin.api_version, 'Cover': 'Big'}
+        send = lambda: self.aladin.http.get(self.item_list_url, params=params)
+        with tracer.span('request_book_info', lookup='item_list', query_type=query_type):
+            response = send() if self.scheduler is None else self.scheduler.request('aladin', send)
+        # same projection as search results, so a prewarmed item becomes the same record when it's chosen
+        with tracer.span('trim_response_to_json', response_bytes=len(response.content)):
+            return decode_item_list(response.content, missing_ok=True)
+
+    def store_items(self, item_list):
+        # returns the number of items the search index didn't have
+        new_count = self.aladin.search_index.add_items(item_list)
+        for item in item_list:
+            # the cache key of lookup_book_info_by_isbn, so typing the isbn of a new release doesn't ask aladin
+            if item['isbn13']:
+                self.aladin.cache.put('isbn:' + item['isbn13'], self.aladin.api_version, [item])
+        return new_count
+
+    def use_budget(self):
+        # counts one call. False when today's budget is used up
+        today = date.today().isoformat()
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO prewarm_usage VALUES (?, 0)', (today,))
+            cursor = self.connection.execute('UPDATE prewarm_usage SET calls = calls + 1 WHERE day = ? AND calls < ?',
+                                             (today, self.daily_budget))
+            self.connection.commit()
+        return cursor.rowcount == 1
+
+    def is_due(self):
+        with self.lock:
+            row = self.connection.execute('SELECT MAX(started_at) FROM prewarm_run').fetchone()
+        return row[0] is None or time.time() - row[0] >= self.interval_sec
+
+    def start_in_background(self, check_interval_sec=600):
+        # runs whenever the last run is older than interval_sec, also across restarts
+        def run_when_due():
+            while not self.stop_event.is_set():
+                if self.is_due():
+                    self.run()
+                self.stop_event.wait(min(check_interval_sec, self.interval_sec))
+
+        thread = threading.Thread(target=run_when_due, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self):
+        with self.lock:
+            row = self.connection.execute('SELECT calls FROM prewarm_usage WHERE day = ?',
+                                          (date.today().isoformat(),)).fetchone()
+            last_run = self.connection.execute('SELECT started_at, calls, items, new_items, error FROM prewarm_run '
+                                               'ORDER BY started_at DESC LIMIT 1').fetchone()
+            total_calls = self.connection.execute('SELECT COALESCE(SUM(calls), 0) FROM prewarm_usage').fetchone()[0]
+        calls_today = row[0] if row else 0
+        stats = {'calls_today': calls_today, 'daily_budget': self.daily_budget, 'total_calls': total_calls,
+                 'indexed_items': self.aladin.search_index.get_stats()['items'], 'last_run': None}
+        if last_run is not None:
+            stats['last_run'] = dict(zip(('started_at', 'calls', 'items', 'new_items', 'error'), last_run))
+        return stats
+
+
+def get_prewarm_category_ids():
+    # BOOK_RECORD_PREWARM_CATEGORIES=1,656 adds the new releases of those aladin CategoryIds
+    value = os.environ.get('BOOK_RECORD_PREWARM_CATEGORIES', '')
+    return tuple(int(category_id) for category_id in value.split(',') if category_id.strip())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fill the local search index from aladin new release and '
+                                                 'bestseller lists')
+    parser.add_argument('command', choices=('run', 'stats'), help='run: pull every feed once (for cron), '
+                                                                  'stats: calls spent and the last run')
+    parser.add_argument('--category', type=int, action='append', default=[], help='aladin CategoryId, repeatable')
+    parser.add_argument('--pages', type=int, default=2, help='pages of 50 items per feed')
+    parser.add_argument('--daily-budget', type=int, default=300, help='aladin calls it may spend a day')
+    args = parser.parse_args()
+
+    My_Cache_Prewarmer = CachePrewarmer(scheduler=build_default_scheduler(max_workers=1),
+                                        category_ids=tuple(args.category) + get_prewarm_category_ids(),
+                                        pages=args.pages, daily_budget=args.daily_budget)
+    if args.command == 'run':
+        run_summary = My_Cache_Prewarmer.run()
+        print(f'{run_summary["items"]} items pulled with {run_summary["calls"]} calls, '
+              f'{run_summary["new_items"]} new to the search index')
+        if run_summary['error']:
+            print(f'stopped by {run_summary["error"]}')
+    prewarm_stats = My_Cache_Prewarmer.get_stats()
+    print(f'{prewarm_stats["calls_today"]} / {prewarm_stats["daily_budget"]} calls spent today, '
+          f'{prewarm_stats["total_calls"]} in total, {prewarm_stats["indexed_items"]} books in the search index')
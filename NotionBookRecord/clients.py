@@ -0,0 +1,136 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from aladin_cache import AladinCache
+from book_search_index import BookSearchIndex
+from tracing import tracer
+
+try:
+    import httpx
+except ImportError:
+    # http/2 is optional. requests with keep-alive is used without it
+    httpx = None
+
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout)
+# raised before the request reached the server
+CONNECT_ERRORS = (requests.ConnectTimeout,)
+if httpx is not None:
+    CONNECTION_ERRORS += (httpx.TransportError,)
+    CONNECT_ERRORS += (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def is_connect_error(error):
+    # True when the server can't have seen the request, so sending it again can't do anything twice
+    if isinstance(error, CONNECT_ERRORS):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+class HttpClient:
+    def __init__(self, timeout_sec=10, pool_size=16, http2=False, headers=None, name='http'):
+        # name labels the spans and metrics of this client, like 'aladin' or 'notion'
+        self.name = name
+        self.timeout_sec = timeout_sec
+        self.http2 = http2 and httpx is not None
+        default_headers = {'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'}
+        default_headers.update(headers or {})
+
+        if self.http2:
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            self.session = httpx.Client(http2=True, limits=limits, timeout=timeout_sec, headers=default_headers)
+        else:
+            # one connection pool per host, reused by every thread until the program ends
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.session.headers.update(default_headers)
+
+    def get(self, url, params=None, headers=None):
+        return self.send('GET', url, params=params, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        return self.send('POST', url, data=data, headers=headers)
+
+    def patch(self, url, data=None, headers=None):
+        return self.send('PATCH', url, data=data, headers=headers)
+
+    def send(self, method, url, params=None, data=None, headers=None):
+        with tracer.span(f'http_{self.name}', method=method) as span:
+            if self.http2:
+                response = self.session.request(method, url, params=params, content=data, headers=headers,
+                                                timeout=self.timeout_sec)
+            else:
+                response = self.session.request(method, url, params=params, data=data, headers=headers,
+                                                timeout=self.timeout_sec)
+            tracer.record_http_response(span, self.name, method, response, len(data or b''))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+shared_http_clients = {}
+shared_http_clients_lock = threading.Lock()
+
+
+def get_shared_http_client(name, **options):
+    with shared_http_clients_lock:
+        if name not in shared_http_clients:
+            shared_http_clients[name] = HttpClient(name=name, **options)
+        return shared_http_clients[name]
+
+
+def is_http2_enabled():
+    return os.environ.get('BOOK_RECORD_HTTP2') == '1'
+
+
+def get_ttb_key():
+    return os.environ.get('ALADIN_TTB_KEY', "ttbjeewoo05211857001")
+
+
+class Aladin:
+    def __init__(self, http=None):
+        # api url and key can be swapped by env, e.g. to point at the fake server of benchmark.py
+        api_url = os.environ.get('ALADIN_API_URL', "http://www.aladin.co.kr")
+        self.request_url = f"{api_url}/ttb/api/ItemSearch.aspx"
+        self.lookup_url = f"{api_url}/ttb/api/ItemLookUp.aspx"
+        self.ttb_key = get_ttb_key()
+        self.api_version = 20131101
+        # aladin gives 10 items a page by default and 50 at most
+        self.max_results = 10
+        self.cache = AladinCache(bypass=os.environ.get('ALADIN_CACHE_BYPASS') == '1')
+        # every item fetched is also indexed, so it can be found again by a different query without aladin
+        self.search_index = BookSearchIndex()
+        self.search_index.index_cached_items(self.cache)
+        # aladin ttb api is served on plain http, so http/2 doesn't apply here
+        self.http = http or get_shared_http_client('aladin', timeout_sec=10)
+
+
+class Notion:
+    def __init__(self, database_id="8c46b8f8ad9d4dd3a299abdf84b5f98f", http=None):
+        self.api_url = os.environ.get('NOTION_API_URL', "https://api.notion.com")
+        self.request_url = f"{self.api_url}/v1/pages"
+        self.authorization_key = os.environ.get('NOTION_AUTHORIZATION_KEY',
+                                                "secret_EpOFfpWXo4HZBTGWOFqK3PV7nH69gkXNo9k5rC8f5bX")
+        self.database_id = database_id
+        self.http = http or get_shared_http_client('notion', timeout_sec=30, http2=is_http2_enabled())
+
+    def get_request_header(self, notion_version="2021-08-16"):
+        return {"Authorization": "Bearer " + self.authorization_key,
+                "Content-Type": "application/json", "Notion-Version": notion_version}
+
+    def get_page_url(self, page_id):
+        return f"{self.request_url}/{page_id}"
+
+    def get_database_url(self):
+        return f"{self.api_url}/v1/databases/{self.database_id}"
+
+    def get_database_query_url(self):
+        return f"{self.api_url}/v1/databases/{self.database_id}/query"
@@ -0,0 +1,197 @@
+import os
+import io
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from clients import CONNECTION_ERRORS, get_shared_http_client
+from data_dir import DATA_DIR
+
+try:
+    from PIL import Image
+except ImportError:
+    # pillow is optional. covers are still mirrored, only without thumbnails
+    Image = None
+
+DEFAULT_STORE_DIR = os.path.join(DATA_DIR, 'covers')
+IMAGE_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+MAX_COVER_SIZE = 5 * 1024 * 1024
+
+
+class CoverStore:
+    # aladin covers are downloaded in the background, kept once per content hash under store_dir,
+    # and notion gets the url of our own mirror (mirror_url serves store_dir as static files).
+    # a cover not ready in time keeps the aladin url, and a broken one is left out of the page
+    def __init__(self, mirror_url, store_dir=DEFAULT_STORE_DIR, max_workers=4, timeout_sec=5,
+                 thumbnail_size=(200, 300)):
+        self.mirror_url = mirror_url.rstrip('/')
+        self.store_dir = store_dir
+        self.thumbnail_size = thumbnail_size
+        self.http = get_shared_http_client('cover', timeout_sec=timeout_sec, pool_size=max_workers)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.downloads = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(store_dir, 'thumbnails'), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(store_dir, 'cover_store.sqlite3'), timeout=30,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # status is 'stored' or 'broken'. file_name is '<sha256><ext>' and shared by every url with the same image
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cover ('
+                                'source_url TEXT PRIMARY KEY, status TEXT NOT NULL, file_name TEXT, '
+                                'has_thumbnail INTEGER NOT NULL, fetched_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def prefetch(self, source_url_list):
+        # starts downloads and returns at once, e.g. while the user is still choosing a candidate
+        for source_url in source_url_list:
+            if source_url:
+                self.get_download(source_url)
+
+    def get_download(self, source_url):
+        with self.lock:
+            if source_url not in self.downloads:
+                self.downloads[source_url] = self.executor.submit(self.fetch, source_url)
+            return self.downloads[source_url]
+
+    def get_cover_url(self, source_url, wait_sec=3):
+        # mirror url when the cover is stored, '' when it is broken, the aladin url when it isn't there yet
+        if not source_url:
+            return ''
+        row = self.get_row(source_url)
+        if row is None:
+            try:
+                self.get_download(source_url).result(timeout=wait_sec)
+            except Exception:
+                # not downloaded in time, or failed. the page keeps the aladin url
+                return source_url
+            row = self.get_row(source_url)
+        if row is None:
+            return source_url
+        status, file_name, has_thumbnail = row
+        if status == 'broken':
+            return ''
+        return f'{self.mirror_url}/{file_name}'
+
+    def get_thumbnail_url(self, source_url):
+        row = self.get_row(source_url)
+        if row is None or row[0] != 'stored' or not row[2]:
+            return None
+        return f'{self.mirror_url}/thumbnails/{row[1]}'
+
+    def get_row(self, source_url):
+        with self.lock:
+            return self.connection.execute('SELECT status, file_name, has_thumbnail FROM cover WHERE source_url = ?',
+                                           (source_url,)).fetchone()
+
+    def fetch(self, source_url):
+        try:
+            self.download(source_url)
+        finally:
+            # only downloads in flight are kept. a failed one is started again by the next request
+            with self.lock:
+                self.downloads.pop(source_url, None)
+
+    def download(self, source_url):
+        if self.get_row(source_url) is not None:
+            return
+        try:
+            response = self.http.get(source_url)
+        except CONNECTION_ERRORS + (requests.RequestException,):
+            # slow or unreachable cdn, or a response cut off. nothing is recorded, so the next request tries again
+            return
+        if response.status_code in (404, 410):
+            self.record(source_url, 'broken', None, False)
+            return
+        if response.status_code != 200:
+            # 5xx or 429 of the cdn goes away. nothing is recorded, so the next request tries again
+            return
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in IMAGE_EXTENSIONS or not 0 < len(response.content) <= MAX_COVER_SIZE:
+            self.record(source_url, 'broken', None, False)
+            return
+
+        file_name = hashlib.sha256(response.content).hexdigest() + IMAGE_EXTENSIONS[content_type]
+        try:
+            self.write_file(file_name, response.content)
+        except OSError:
+            # disk full or not writable. tried again by the next request
+            return
+        self.record(source_url, 'stored', file_name, self.write_thumbnail(file_name, response.content))
+
+    def write_file(self, file_name, content):
+        path = os.path.join(self.store_dir, file_name)
+        if os.path.exists(path):
+            return
+        # written aside and renamed, so the mirror never serves half a file
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    def write_thumbnail(self, file_name, content):
+        if Image is None:
+            return False
+        path = os.path.join(self.store_dir, 'thumbnails', file_name)
+        if os.path.exists(path):
+            return True
+        try:
+            with Image.open(io.BytesIO(content)) as image:
+                image.thumbnail(self.thumbnail_size)
+                output = io.BytesIO()
+                image.save(output, format=image.format)
+        except (OSError, ValueError):
+            return False
+        self.write_file(os.path.join('thumbnails', file_name), output.getvalue())
+        return True
+
+    def record(self, source_url, status, file_name, has_thumbnail):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cover VALUES (?, ?, ?, ?, ?)',
+                                    (source_url, status, file_name, int(has_thumbnail), time.time()))
+            self.connection.commit()
+
+    def forget_broken(self):
+        # broken covers are tried again on the next request
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM cover WHERE status = 'broken'")
+            self.connection.commit()
+        return cursor.rowcount
+
+    def get_stats(self):
+        with self.lock:
+            counts = dict(self.connection.execute('SELECT status, COUNT(*) FROM cover GROUP BY status').fetchall())
+            counts['files'] = self.connection.execute('SELECT COUNT(DISTINCT file_name) FROM cover '
+                                                      'WHERE file_name IS NOT NULL').fetchone()[0]
+        return counts
+
+
+shared_cover_store = None
+shared_cover_store_lock = threading.Lock()
+
+
+def get_shared_cover_store():
+    # covers are mirrored only when BOOK_RECORD_COVER_MIRROR_URL is set. otherwise notion keeps aladin urls
+    global shared_cover_store
+    mirror_url = os.environ.get('BOOK_RECORD_COVER_MIRROR_URL')
+    if not mirror_url:
+        return None
+    with shared_cover_store_lock:
+        if shared_cover_store is None:
+            shared_cover_store = CoverStore(mirror_url)
+        return shared_cover_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local cover mirror')
+    parser.add_argument('command', choices=('stats', 'forget-broken'))
+    args = parser.parse_args()
+
+    My_Cover_Store = CoverStore(os.environ.get('BOOK_RECORD_COVER_MIRROR_URL', ''))
+    if args.command == 'forget-broken':
+        print(f'{My_Cover_Store.forget_broken()} broken covers will be tried again')
+    print(My_Cover_Store.get_stats())
@@ -0,0 +1,78 @@
+import os
+import json
+import argparse
+
+from data_dir import DATA_DIR
+from scheduler import TokenBucket, QuotaExceededError, QuotaUsage, DEFAULT_USAGE_PATH
+
+DEFAULT_CREDENTIALS_PATH = os.environ.get('BOOK_RECORD_CREDENTIALS', os.path.join(DATA_DIR, 'credentials.json'))
+
+
+class CredentialPool:
+    # aladin ttb keys and notion integration tokens read from a json file like
+    # {"aladin": [{"name": "ttb-1", "ttb_key": "...", "daily_quota": 5000}],
+    #  "notion": [{"name": "integration-1", "authorization_key": "secret_..."}]}
+    # calls of each aladin key are counted per day by its ttb key, shared with single-key runs of the same key
+    def __init__(self, credentials_path=DEFAULT_CREDENTIALS_PATH, db_path=DEFAULT_USAGE_PATH):
+        with open(credentials_path, encoding='utf8') as f:
+            credentials = json.load(f)
+        self.aladin_keys = [dict({'daily_quota': 5000, 'rate_per_sec': 10}, **key)
+                            for key in credentials.get('aladin', [])]
+        self.notion_tokens = [dict({'rate_per_sec': 3}, **token) for token in credentials.get('notion', [])]
+        if not self.aladin_keys or not self.notion_tokens:
+            raise ValueError(f'{credentials_path} needs at least one aladin key and one notion token')
+        self.usage = QuotaUsage(db_path)
+
+    def get_aladin_key(self, name):
+        return next(key for key in self.aladin_keys if key['name'] == name)
+
+    def get_notion_token(self, name):
+        return next(token for token in self.notion_tokens if token['name'] == name)
+
+    def use_aladin_key(self, name):
+        # counts one call. False when the key has no call left today
+        key = self.get_aladin_key(name)
+        return self.usage.use(key['ttb_key'], key['daily_quota'])
+
+    def get_remaining_quota(self):
+        # {aladin key name: calls left today}
+        used_by_ttb_key = self.usage.get_used_today()
+        return {key['name']: max(0, key['daily_quota'] - used_by_ttb_key.get(key['ttb_key'], 0))
+                for key in self.aladin_keys}
+
+    def get_available_aladin_keys(self):
+        # keys with calls left today, the most left first
+        remaining_quota = self.get_remaining_quota()
+        return sorted((key for key in self.aladin_keys if remaining_quota[key['name']] > 0),
+                      key=lambda key: remaining_quota[key['name']], reverse=True)
+
+    def lease_aladin_key(self):
+        # the key with the most calls left today, or None when every key is used up
+        available_keys = self.get_available_aladin_keys()
+        return available_keys[0] if available_keys else None
+
+
+class PooledQuotaBucket(TokenBucket):
+    # rate limit of this process, with the daily quota of the key counted in the pool across every process.
+    # the key can be swapped for another one when it's used up
+    def __init__(self, credential_pool, key_name, rate_per_sec):
+        super().__init__(rate_per_sec)
+        self.credential_pool = credential_pool
+        self.key_name = key_name
+
+    def use_daily_quota(self):
+        key_name = self.key_name
+        if not self.credential_pool.use_aladin_key(key_name):
+            raise QuotaExceededError(f'daily quota of {key_name} is used up')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='aladin calls left today for each key of the credential pool')
+    parser.add_argument('--credentials', default=DEFAULT_CREDENTIALS_PATH)
+    args = parser.parse_args()
+
+    My_Credential_Pool = CredentialPool(args.credentials)
+    for remaining_key_name, remaining_count in My_Credential_Pool.get_remaining_quota().items():
+        daily_quota = My_Credential_Pool.get_aladin_key(remaining_key_name)['daily_quota']
+        print(f'{remaining_key_name}: {remaining_count} / {daily_quota} calls left today')
+    print(f'{len(My_Credential_Pool.notion_tokens)} notion tokens')
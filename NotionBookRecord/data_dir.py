@@ -0,0 +1,5 @@
+import os
+
+# every sqlite file, cover and export of the scripts is kept here. BOOK_RECORD_DATA_DIR moves them elsewhere,
+# e.g. to a temp dir for the benchmark
+DATA_DIR = os.environ.get('BOOK_RECORD_DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
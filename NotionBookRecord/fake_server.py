@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import uuid
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_RESPONSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_data')
+
+
+def is_matched(page, condition):
+    timestamp = condition['timestamp']
+    value = parse_time(page[timestamp])
+    for operator, bound in condition[timestamp].items():
+        if operator == 'on_or_after' and value < parse_time(bound):
+            return False
+        if operator == 'before' and value >= parse_time(bound):
+            return False
+    return True
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+class FakeBookApiServer:
+    # stands in for both www.aladin.co.kr and api.notion.com on localhost.
+    # aladin searches replay recorded responses, notion pages are accepted and thrown away
+    def __init__(self, aladin_latency_sec=0.0, notion_latency_sec=0.0, notion_429_every=0, retry_after_sec=1,
+                 response_dir=DEFAULT_RESPONSE_DIR, port=0):
+        self.aladin_latency_sec = aladin_latency_sec
+        self.notion_latency_sec = notion_latency_sec
+        self.notion_429_every = notion_429_every
+        self.retry_after_sec = retry_after_sec
+        self.item_search_response = self.load_response(response_dir, 'aladin_item_search.json')
+        self.item_lookup_response = self.build_item_lookup_response()
+        # pages answered by database queries, e.g. for an export. empty by default
+        self.notion_pages = []
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.build_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def load_response(self, response_dir, file_name):
+        with open(os.path.join(response_dir, file_name), encoding='utf8') as f:
+            return json.load(f)
+
+    def build_item_lookup_response(self):
+        response = dict(self.item_search_response)
+        response['item'] = response['item'][:1]
+        return response
+
+    def get_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self, name):
+        with self.lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+            return self.request_counts[name]
+
+    def query_pages(self, request_body):
+        # timestamp filters (alone or in 'and'), one timestamp sort and cursor pagination, like notion
+        conditions = request_body.get('filter', {})
+        conditions = conditions.get('and', [conditions] if conditions else [])
+        pages = [page for page in self.notion_pages if all(is_matched(page, condition) for condition in conditions)]
+        for sort in request_body.get('sorts', []):
+            pages.sort(key=lambda page: page[sort['timestamp']], reverse=sort['direction'] == 'descending')
+        start = int(request_body.get('start_cursor') or 0)
+        end = start + request_body.get('page_size', 100)
+        return {'object': 'list', 'results': pages[start:end], 'has_more': end < len(pages),
+                'next_cursor': str(end) if end < len(pages) else None}
+
+    def get_page(self, page_id):
+        return next((page for page in self.notion_pages if page['id'] == page_id), None)
+
+    def get_database_properties(self):
+        properties = {}
+        for page in self.notion_pages[:1]:
+            properties = {name: {'type': value['type']} for name, value in page['properties'].items()}
+        return properties
+
+    def build_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith('/ItemSearch.aspx'):
+                    fake_server.count_request('aladin_item_search')
+                    time.sleep(fake_server.aladin_latency_sec)
+                    self.send_json(200, fake_server.item_search_response)
+                elif url.path.endswith('/ItemList.aspx'):
+                    fake_server.count_request('aladin_item_list')
+                    time.sleep(fake_server.aladin_latency_sec)
+                    self.send_json(200, fake_server.item_search_response)
+                elif url.path.endswith('/ItemLookUp.aspx'):
+                    fake_server.count_request('aladin_item_lookup')
+                    time.sleep(fake_server.aladin_latency_sec)
+                    if parse_qs(url.query).get('ItemId'):
+                        self.send_json(200, fake_server.item_lookup_response)
+                    else:
+                        self.send_json(200, {'errorCode': 8, 'errorMessage': '잘못된 ItemId'})
+                elif url.path.startswith('/v1/pages/'):
+                    fake_server.count_request('notion_page')
+                    page = fake_server.get_page(url.path.rsplit('/', 1)[-1])
+                    if page is None:
+                        self.send_json(404, {'object': 'error', 'code': 'object_not_found'})
+                    else:
+                        self.send_json(200, page)
+                elif url.path.startswith('/v1/databases/'):
+                    fake_server.count_request('notion_database')
+                    self.send_json(200, {'object': 'database', 'properties': fake_server.get_database_properties()})
+                elif url.path.startswith('/covers/'):
+                    self.send_cover(url.path)
+                else:
+                    self.send_json(404, {'message': 'not found'})
+
+            def send_cover(self, path):
+                # /covers/<name>.jpg answers with a tiny image made from the name, /covers/broken/... with 404
+                fake_server.count_request('cover')
+                time.sleep(fake_server.aladin_latency_sec)
+                if path.startswith('/covers/broken/'):
+                    self.send_json(404, {'message': 'not found'})
+                    return
+                body = b'\xff\xd8\xff\xe0' + path.rsplit('/', 1)[-1].split('.')[0].encode('utf8') + b'\xff\xd9'
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                url = urlparse(self.path)
+                if url.path == '/v1/pages':
+                    count = fake_server.count_request('notion_pages')
+                    time.sleep(fake_server.notion_latency_sec)
+                    if fake_server.notion_429_every and count % fake_server.notion_429_every == 0:
+                        self.send_json(429, {'object': 'error', 'code': 'rate_limited'},
+                                       {'Retry-After': str(fake_server.retry_after_sec)})
+                        return
+                    json.loads(body)
+                    self.send_json(200, {'object': 'page', 'id': str(uuid.uuid4())})
+                elif url.path.endswith('/query'):
+                    fake_server.count_request('notion_query')
+                    time.sleep(fake_server.notion_latency_sec)
+                    self.send_json(200, fake_server.query_pages(json.loads(body or b'{}')))
+                else:
+                    self.send_json(404, {'message': 'not found'})
+
+            def do_PATCH(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                url = urlparse(self.path)
+                if url.path.startswith('/v1/pages/'):
+                    fake_server.count_request('notion_page_patch')
+                    time.sleep(fake_server.notion_latency_sec)
+                    json.loads(body)
+                    self.send_json(200, {'object': 'page', 'id': url.path.rsplit('/', 1)[-1]})
+                else:
+                    self.send_json(404, {'message': 'not found'})
+
+            def send_json(self, status_code, data, headers=None):
+                body = json.dumps(data, ensure_ascii=False).encode('utf8')
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,249 @@
+import os
+import re
+import sys
+import time
+import codecs
+import shutil
+import selectors
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aladin_cache import normalize_query
+from timed_input import stdin_line_reader
+
+ESCAPE_SEQUENCE_RE = re.compile(r'\x1b(\[[0-9;]*[A-Za-z~]?|.)?')
+
+
+class LiveSearch:
+    # candidates for a query that is still being typed. each keystroke shows what is known right away
+    # (cache, the results of a shorter query filtered locally, or the search index), and aladin is asked
+    # only after the typing pauses for debounce_sec. results of a query typed over are dropped,
+    # since requests can't be taken back
+    def __init__(self, engine, on_results, debounce_sec=0.25, min_query_len=2, recent_size=64):
+        self.engine = engine
+        self.on_results = on_results
+        self.debounce_sec = debounce_sec
+        self.min_query_len = min_query_len
+        self.recent_size = recent_size
+        # normalized query -> item list of page 1, most recent last
+        self.recent_results = OrderedDict()
+        self.generation = 0
+        self.timer = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(2)
+
+    def update_query(self, query):
+        query_key = normalize_query(query)
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if len(query_key) < self.min_query_len:
+            self.on_results(query, [], 'empty')
+            return
+
+        item_list, source = self.find_known_results(query, query_key)
+        if item_list is not None:
+            self.on_results(query, item_list, source)
+            if source == 'cache':
+                return
+
+        timer = threading.Timer(self.debounce_sec, self.search, (query, generation))
+        timer.daemon = True
+        with self.lock:
+            if generation == self.generation:
+                self.timer = timer
+                timer.start()
+
+    def find_known_results(self, query, query_key):
+        # (item list, 'cache') for a query searched before, (item list, 'filtered') for a longer version of one
+        with self.lock:
+            item_list = self.recent_results.get(query_key)
+        if item_list is None:
+            # not counted in the cache stats. only a query aladin is asked for is a miss
+            item_list = self.engine.get_cached_book_info(query, count=False)
+        if item_list is not None:
+            self.remember(query_key, item_list)
+            return item_list, 'cache'
+
+        with self.lock:
+            prefix_keys = [key for key in self.recent_results if query_key.startswith(key)]
+            item_list = self.recent_results[max(prefix_keys, key=len)] if prefix_keys else []
+        words = query_key.split()
+        filtered_list = [item for item in item_list
+                         if all(word in normalize_query(f'{item["title"]} {item["author"]}') for word in words)]
+        if filtered_list:
+            return filtered_list, 'filtered'
+        # (item list, 'local') of books fetched before by other queries, best match first
+        item_list = self.engine.search_local_book_info(query, min_confidence=0)
+        return (item_list, 'local') if item_list else (None, None)
+
+    def search(self, query, generation):
+        if generation != self.generation:
+            return
+        try:
+            item_list = self.engine.search_book_info(query)
+        except Exception:
+            return
+        self.remember(normalize_query(query), item_list)
+        if generation == self.generation:
+            self.on_results(query, item_list, 'aladin')
+
+    def remember(self, query_key, item_list):
+        with self.lock:
+            self.recent_results[query_key] = item_list
+            self.recent_results.move_to_end(query_key)
+            while len(self.recent_results) > self.recent_size:
+                self.recent_results.popitem(last=False)
+
+    def prefetch_page(self, query, page):
+        # the next page is asked while the current one is read, so 'n' shows it from the cache
+        self.executor.submit(self.engine.search_book_info, query, page)
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+class LiveSearchPrompt:
+    # terminal front of LiveSearch. the query line and the first few candidates are redrawn on every keystroke,
+    # and enter takes the query with its candidates to the usual choose step
+    def __init__(self, live_search, max_shown=5, timeout_sec=600, stats=None):
+        self.live_search = live_search
+        self.live_search.on_results = self.show_results
+        self.max_shown = max_shown
+        self.timeout_sec = timeout_sec
+        self.stats = stats
+        self.query = ''
+        self.shown_query = None
+        self.shown_item_list = []
+        self.shown_source = None
+        self.typed_at = None
+        self.lock = threading.Lock()
+
+    def run(self, prompt):
+        # returns (query, candidate list or None when it should be searched)
+        # the query line has to be a single line to be redrawn in place
+        self.prompt = prompt.lstrip('\n')
+        print('\n' * (len(prompt) - len(self.prompt)), end='')
+        self.query = ''
+        self.shown_query, self.shown_item_list, self.shown_source = None, [], None
+        self.draw()
+        with CbreakTerminal() as terminal:
+            while True:
+                text = terminal.read(self.timeout_sec)
+                if text is None:
+                    print(f"\nno input for {self.timeout_sec / 60:.0f} minutes. program exited.")
+                    sys.exit()
+                for char in ESCAPE_SEQUENCE_RE.sub('', text):
+                    if char in '\r\n':
+                        return self.finish()
+                    if char == '\x04' and not self.query:
+                        raise EOFError
+                    self.edit_query(char)
+
+    def edit_query(self, char):
+        if char in '\x7f\x08':
+            self.query = self.query[:-1]
+        elif char == '\x15':
+            # ctrl-u clears the line
+            self.query = ''
+        elif char.isprintable():
+            self.query += char
+        else:
+            return
+        self.typed_at = time.monotonic()
+        self.draw()
+        self.live_search.update_query(self.query)
+
+    def show_results(self, query, item_list, source):
+        with self.lock:
+            if query != self.query:
+                return
+            self.shown_query, self.shown_item_list, self.shown_source = query, item_list, source
+            if self.stats is not None and self.typed_at is not None and item_list:
+                self.stats.add_stage_timing(f'live_{source}', time.monotonic() - self.typed_at)
+                self.typed_at = None
+        self.draw()
+
+    def finish(self):
+        self.live_search.cancel()
+        self.clear()
+        print(f'{self.prompt}{self.query}')
+        if self.shown_query == self.query and self.shown_source in ('cache', 'aladin'):
+            return self.query, self.shown_item_list
+        return self.query, None
+
+    def draw(self):
+        with self.lock:
+            lines = [f'{self.prompt}{self.query}']
+            # korean chars take two columns, so half the width keeps every candidate on one line
+            max_chars = shutil.get_terminal_size().columns // 2
+            if self.shown_query == self.query:
+                for i, item in enumerate(self.shown_item_list[:self.max_shown]):
+                    lines.append(f'   {i + 1}) {item["title"]} / {item["author"]}'[:max_chars])
+                if self.shown_source in ('filtered', 'local'):
+                    lines.append('   ...')
+            # the cursor always rests at the end of the query line. clear from there down, draw the candidates,
+            # then go back up and write the query line again so the cursor ends up after it, whatever the char width
+            output = '\r\x1b[J' + '\n'.join(lines)
+            if len(lines) > 1:
+                output += f'\x1b[{len(lines) - 1}A\r{lines[0]}'
+            sys.stdout.write(output)
+            sys.stdout.flush()
+
+    def clear(self):
+        with self.lock:
+            sys.stdout.write('\r\x1b[J')
+            sys.stdout.flush()
+
+
+class CbreakTerminal:
+    # keys come one by one without waiting for enter. ctrl-c still works and the terminal is restored on exit
+    def __enter__(self):
+        import termios
+        import tty
+
+        self.fd = sys.stdin.fileno()
+        self.saved_attributes = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)
+        self.decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        return self
+
+    def read(self, timeout_sec):
+        # decoded text of the keys pressed, or None after timeout_sec without a key
+        if stdin_line_reader.pending:
+            pending, stdin_line_reader.pending = stdin_line_reader.pending, b''
+            return self.decoder.decode(pending)
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.fd, selectors.EVENT_READ)
+            if not selector.select(timeout_sec):
+                return None
+        chunk = os.read(self.fd, 1024)
+        if not chunk:
+            raise EOFError
+        return self.decoder.decode(chunk)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import termios
+
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_attributes)
+        return False
+
+
+def is_live_search_supported():
+    # needs a real terminal. on windows or with piped stdin the usual line prompt is used
+    if os.name == 'nt' or not hasattr(sys.stdin, 'isatty') or not sys.stdin.isatty():
+        return False
+    try:
+        import termios
+        import tty
+    except ImportError:
+        return False
+    return True
@@ -1,47 +1,217 @@
-import sys
-import requests
-import json
-from datetime import datetime
+import os
+import uuid
+import argparse
+
+from book_normalize import is_isbn
+from cache_prewarm import CachePrewarmer, get_prewarm_category_ids
+from pipeline import BookRecordEngine
+from live_search import LiveSearch, LiveSearchPrompt, is_live_search_supported
+from post_queue import drain_post_queue
+from profiles import BOOK_PROFILE, PROFILES
+from scheduler import build_default_scheduler, QuotaExceededError
+from session_stats import SessionStats
+from timed_input import input_w_timeout
+from tracing import tracer
 
 
 class AutoBookRecord:
-    def __init__(self):
-        self.aladin = Aladin()
-        self.notion = Notion()
+    def __init__(self, profile=BOOK_PROFILE, live=False):
+        # one request at a time, and every aladin call counts against the daily quota of the ttb key
+        self.engine = BookRecordEngine(profile, scheduler=build_default_scheduler(max_workers=1))
+        self.aladin = self.engine.aladin
+        self.notion = self.engine.notion
+        self.notion_index = self.engine.notion_index
         self.book = None
+        self.title = None
+        self.candidate_book_list = None
+        self.candidate_page = 1
+        self.stats = SessionStats()
+        # candidates show up while the title is typed. only on a real terminal
+        self.live_search = None
+        if live and is_live_search_supported():
+            self.live_search = LiveSearch(self.engine, on_results=None)
+            self.live_search_prompt = LiveSearchPrompt(self.live_search, stats=self.stats)
+        self.sync_notion_index()
+        self.post_queued_books()
+        self.prewarm_search_index()
         self.execute_auto_book_record()
 
-    def execute_auto_book_record(self):
-        title = self.get_target_book_title()
+    def sync_notion_index(self):
+        try:
+            self.notion_index.sync()
+        except Exception:
+            print('Couldn\'t sync with your notion. Duplicate check might miss recently added books.')
+
+    def post_queued_books(self):
+        # books that couldn't reach notion last time, and a post cut off by ctrl-c. the one cut off is
+        # checked against the synced index first, so it isn't added twice
+        post_queue = self.engine.post_queue
+        post_queue.recover_in_flight(self.engine.profile.name)
+        post_queue.make_pending_due(self.engine.profile.name)
+        counts = drain_post_queue(post_queue, lambda profile_name: self.engine, wait=False,
+                                  profile_name=self.engine.profile.name)
+        if counts['added']:
+            print(f'{counts["added"]} books queued last time are now in your notion.')
+        # books still waiting are reserved, so adding one of them again doesn't queue it twice
+        for job in post_queue.get_pending_jobs(self.engine.profile.name):
+            self.notion_index.reserve(job['title'], job['info_url'], job['isbn'])
+
+    def prewarm_search_index(self):
+        # new releases and bestsellers go into the search index while you type, when the last pull is 6 hours old.
+        # BOOK_RECORD_PREWARM=0 turns it off
+        if os.environ.get('BOOK_RECORD_PREWARM') == '0':
+            return
+        self.prewarmer = CachePrewarmer(self.aladin, scheduler=self.engine.scheduler,
+                                        category_ids=get_prewarm_category_ids())
+        self.prewarmer.start_in_background()
 
+    def execute_auto_book_record(self):
+        # search -> choose -> post -> search ... as a loop, so the stack doesn't grow with every book added
+        stage = 'search'
+        try:
+            while True:
+                try:
+                    stage = self.run_stage(stage)
+                except QuotaExceededError:
+                    print('\nToday\'s aladin quota is used up. Only books searched before can be found until tomorrow.')
+                    stage = 'search'
+        except (KeyboardInterrupt, EOFError):
+            pass
+        finally:
+            self.stats.print_summary()
+            tracer.export()
+
+    def run_stage(self, stage):
+        if stage == 'search':
+            return self.run_search_stage()
+        if stage == 'choose':
+            return self.run_choose_stage()
+        if stage == 'post':
+            return self.run_post_stage()
+        raise ValueError(f'unknown stage: {stage}')
+
+    def run_search_stage(self):
+        self.reset()
+        candidate_book_list = None
+        with self.stats.measure('input'):
+            if self.live_search is not None:
+                title, candidate_book_list = self.live_search_prompt.run('\nplease enter book title: ')
+            else:
+                title = self.get_target_book_title()
         if self.is_not_valid(title):
-            self.reset()
-            return
-        candidate_book_list = self.get_book_info_list(title)
-        chosen_book_index_num = self.request_user_book_choice(candidate_book_list)
-        book = candidate_book_list[chosen_book_index_num]
-        self.set_book_configuration(book)
+            return 'search'
+        if is_isbn(title.replace('-', '')):
+            return self.run_isbn_lookup_stage(title)
 
-        result = self.post_book_info_to_notion()
+        self.title = title
+        with self.stats.measure('lookup'):
+            if candidate_book_list:
+                self.candidate_book_list = self.engine.rank_candidates(title, candidate_book_list)
+            else:
+                self.candidate_book_list = self.get_local_book_info_list(title) or self.get_book_info_list(title)
+        if self.candidate_book_list is None:
+            return 'search'
+        self.prefetch_next_candidate_page()
+        # covers download while the user is choosing
+        self.engine.prefetch_covers(self.candidate_book_list)
+        return 'choose'
+
+    def run_isbn_lookup_stage(self, isbn):
+        # isbn points to exactly one book, so there's nothing to choose
+        with self.stats.measure('lookup'):
+            result = self.engine.lookup_book_info_by_isbn(isbn)
+        if len(result) < 1:
+            print('There\'s no book with this isbn.')
+            return 'search'
+        self.set_book_configuration(result[0])
+        print(f'\n{self.book.title} / {self.book.author} / {self.book.publisher}')
+        if self.is_duplicate_not_wanted(self.book):
+            return 'search'
+        return 'post'
+
+    def run_choose_stage(self):
+        with self.stats.measure('choose'):
+            chosen_book_index_num = self.request_user_book_choice(self.candidate_book_list)
+        if chosen_book_index_num == 'next':
+            return self.run_next_candidate_page_stage()
+        if chosen_book_index_num is None:
+            return 'search'
+        self.set_book_configuration(self.candidate_book_list[chosen_book_index_num])
+        if self.is_duplicate_not_wanted(self.book):
+            return 'search'
+        return 'post'
+
+    def run_post_stage(self):
+        with self.stats.measure('post'):
+            result = self.post_book_info_to_notion()
+        if result == 'already_queued':
+            print('\nThis book is already in the queue. It will be added on the next start.')
+            return 'search'
+        self.stats.add_result(result)
         self.notify_result_to_user(result)
+        return 'search'
+
+    def run_next_candidate_page_stage(self):
+        with self.stats.measure('lookup'):
+            candidate_book_list = self.get_book_info_list(self.title, self.candidate_page + 1)
+        if candidate_book_list is None:
+            return 'choose'
+        self.candidate_book_list = candidate_book_list
+        self.candidate_page += 1
+        self.prefetch_next_candidate_page()
+        return 'choose'
+
+    def has_next_candidate_page(self):
+        return self.candidate_page == 0 or len(self.candidate_book_list) >= self.aladin.max_results
+
+    def prefetch_next_candidate_page(self):
+        # the next page is asked while this one is read, so 'n' shows it right away. live mode only, for ttb quota
+        if self.live_search is not None and self.has_next_candidate_page():
+            self.live_search.prefetch_page(self.title, self.candidate_page + 1)
+
+    def is_duplicate_not_wanted(self, book):
+        page_id = self.notion_index.find_duplicate(book.title, book.info_url)
+        if page_id is None:
+            return False
+        answer = input_w_timeout('\nThis book is already in your notion. '
+                                 'Add it anyway(y), update the existing page(u) or skip(n)? ').lower()
+        if answer == 'u':
+            self.update_existing_page(page_id, book)
+            return True
+        return answer != 'y'
+
+    def update_existing_page(self, page_id, book):
+        if self.engine.stage_book_update(page_id, book) == 'unchanged':
+            print('\nNothing to update. The page already has the same info.')
+            return
+        updated_count, failed_count = self.engine.update_batch.flush()
+        self.notify_result_to_user('added' if failed_count == 0 else 'post_failed')
 
     def reset(self):
         self.book = None
-        self.execute_auto_book_record()
+        self.title = None
+        self.candidate_book_list = None
+        self.candidate_page = 1
 
     def get_target_book_title(self):
         title = input_w_timeout('\nplease enter book title: ')
         return title
 
-    def get_book_info_list(self, title):
-        response = self.request_book_info(title)
-        result = self.trim_response_to_json(response)
+    def get_local_book_info_list(self, title):
+        # books fetched before that clearly match, without asking aladin.
+        # they are page 0, so 'n' goes on to page 1 of aladin
+        result = self.engine.search_local_book_info(title)
+        if result is not None:
+            self.candidate_page = 0
+        return result
+
+    def get_book_info_list(self, title, page=1):
+        result = self.engine.search_book_info(title, page)
         if len(result) < 1:
             print('There\'s no matching result.')
-            self.reset()
             return
         # if result has no element, it means there's no matching result
-        return result
+        return self.engine.rank_candidates(title, result)
 
     def request_user_book_choice(self, candidate_book_list):
         candidate_book_list_for_print = []
@@ -55,18 +225,24 @@ class AutoBookRecord:
                 f'{i + 1}) title: {title}\n   author: {author}\n   publisher: {publisher}\n   pubDate: {pub_date}')
 
         # ------------------------ printed for user ------------------------
-        print('\nBelow books were found according to your input\n')
+        if self.candidate_page == 0:
+            print('\nBelow books were found among the books you searched before\n')
+        else:
+            print('\nBelow books were found according to your input\n')
         for book in candidate_book_list_for_print:
             print(book)
         print('\nYou can press \'b\' to go back.')
+        if self.has_next_candidate_page():
+            print('You can press \'n\' to see more books.')
         chosen_book_index_str = input_w_timeout('Please enter the number of the book you want to add: ')
         # ------------------------ printed for user ------------------------
 
         chosen_book_index_num = 0
         while chosen_book_index_num < 1:
             if chosen_book_index_str == 'b':
-                self.reset()
                 return
+            if chosen_book_index_str == 'n' and self.has_next_candidate_page():
+                return 'next'
 
             if chosen_book_index_str in list(map(str, range(1, len(candidate_book_list) + 1))):
                 chosen_book_index_num = int(chosen_book_index_str)
@@ -75,233 +251,40 @@ class AutoBookRecord:
 
         return chosen_book_index_num - 1
 
-    def request_book_info(self, title):
-        params = {'TTBKey': self.aladin.ttb_key, 'Query': title, 'Output': 'JS', 'Version': 20131101, 'Cover': 'Big'}
-        response = requests.get(url=self.aladin.request_url, params=params)
-        return response
-
-    def trim_response_to_json(self, raw_response):
-        return json.loads(raw_response.text)['item']
-
     def set_book_configuration(self, book):
-        b = book
-        aladin_category = self.parse_category(b['categoryName'])
-        category = self.get_correspondence_kyobo_category(aladin_category)
-        p = self.parse_author_w_translator(b['author'])
-        authors = p['authors']
-        translator = p['translator']
-
-        self.book = Book(
-            title=b['title'],
-            author=authors,
-            publisher=b['publisher'],
-            translator=translator,
-            image=b['cover'],
-            info_url=b['link'],
-            category=category
-        )
-
-    def parse_category(self, category_str):
-        categories = category_str.split('>')
-        if len(categories) < 2:
-            return ''
-        return categories[1]
-
-    def parse_author_w_translator(self, author_str):
-        author_list = []
-        default_translator = '-'
-        authors = author_str.split(', ')
-        for author in authors:
-            if '옮긴이' not in author:
-                author_list.append(author.replace(' (지은이)', ''))
-            else:
-                default_translator = author.replace('(옮긴이)', '')
-
-        return {'authors': ', '.join(author_list), 'translator': default_translator}
+        self.book = self.engine.build_book(book)
 
     def post_book_info_to_notion(self):
-        result = self.request_notion_database_post()
-        return result
-
-    def request_notion_database_post(self):
         if self.book is None:
             return
-
-        request_header = {"Authorization": "Bearer " + self.notion.authorization_key,
-                          "Content-Type": "application/json", "Notion-Version": "2021-08-16"}
-        request_body = self.trim_book_info_to_json()
-        response = requests.post(url=self.notion.request_url, data=request_body, headers=request_header)
-        if '200' in str(response):
-            return True
-        return False
-
-    def trim_book_info_to_json(self):
-        data = {}
-        data["parent"] = self.build_parent_part_of_body()
-        data["cover"] = self.build_cover_part_of_body()
-        data["properties"] = self.build_properties_part_of_body()
-        return json.dumps(data, ensure_ascii=False).encode('utf8')
-
-    def build_parent_part_of_body(self):
-        return {"database_id": self.notion.database_id}
-
-    def build_cover_part_of_body(self):
-        return {"type": "external", "external": {"url": self.book.image}}
-
-    def build_properties_part_of_body(self):
-        return {"title": {"title": [{"text": {"content": self.book.title}}]},
-                "대분류": {"select": {"name": self.book.category}},
-                "지은이": {"rich_text": [{"type": "text", "text": {"content": self.book.author}}]},
-                "출판사": {"rich_text": [{"type": "text", "text": {"content": self.book.publisher}}]},
-                "옮긴이": {"rich_text": [{"type": "text", "text": {"content": self.book.translator}}]},
-                "책 정보(알라딘)": {"url": self.book.info_url},
-                "읽은 날짜": {"date": {"start": datetime.now().isoformat()[:10], "end": None}}}
+        # reserved until notion has it. a reserved book with no page yet is waiting in the queue
+        if not self.notion_index.reserve(self.book.title, self.book.info_url) and \
+                self.notion_index.find_duplicate(self.book.title, self.book.info_url) is None:
+            return 'already_queued'
+        # the book is queued first, so it isn't lost when notion can't be reached
+        result = self.engine.post_book_through_queue(self.book, str(uuid.uuid4()))
+        if result == 'post_failed':
+            self.notion_index.release(self.book.title, self.book.info_url)
+        return result
 
     def is_not_valid(self, input):
-        if input is None or type(input) != str or input == "":
+        if input is None or type(input) != str or input.strip() == "":
             return True
         return False
 
     def notify_result_to_user(self, result):
-        if result:
+        if result == 'added':
             print("\nSuccessfully done! It might take few seconds.\nPlease check your notion :)")
+        elif result == 'queued':
+            print('\nCouldn\'t reach your notion. The book is kept in the queue and will be added on the next start.')
         else:
             print("\nSomething got wrong. Please try again.")
-        self.reset()
-
-    def get_correspondence_kyobo_category(self, category):
-        aladin_to_kyobo = {'요리/살림': '기타',
-                           '건강/취미': '기타',
-                           '경제경영': '경제/경영',
-                           '고전': '기타',
-                           '과학': '과학',
-                           '달력/기타': '기타',
-                           '대학교재': '기타',
-                           '만화': '기타',
-                           '사회과학': '정치/사회',
-                           '소설/시/희곡': '소설',
-                           '에세이': '에세이',
-                           '수험서/자격증': '기타',
-                           '공무원 수험서': '기타',
-                           '어린이': '기타',
-                           '유아': '기타',
-                           '여행': '기타',
-                           '역사': '역사/문화',
-                           '예술/대중문화': '예술/대중문화',
-                           '외국어': '외국어',
-                           '인문학': '인문',
-                           '자기계발': '자기계발',
-                           '잡지': '잡지',
-                           '장르소설': '소설',
-                           '전집/중고전집': '기타',
-                           '종교/역학': '종교',
-                           '좋은부모': '기타',
-                           '청소년': '기타',
-                           '초등참고서': '기타',
-                           '중학교참고서': '기타',
-                           '고등학교참고서': '기타',
-                           '컴퓨터/모바일': '컴퓨터/IT',
-                           }
-        try:
-            return aladin_to_kyobo[category]
-        except KeyError:
-            return '알 수 없음'
-
-
-class Book:
-    def __init__(self, title, author, publisher, translator, image, info_url, category):
-        self.title = title
-        self.author = author
-        self.publisher = publisher
-        self.translator = translator
-        self.image = image
-        self.info_url = info_url
-        self.category = category
-
-
-class Aladin:
-    def __init__(self):
-        self.request_url = "http://www.aladin.co.kr/ttb/api/ItemSearch.aspx"
-        self.ttb_key = "ttbjeewoo05211857001"
-
-
-class Notion:
-    def __init__(self):
-        self.request_url = "https://api.notion.com/v1/pages"
-        self.authorization_key = "secret_EpOFfpWXo4HZBTGWOFqK3PV7nH69gkXNo9k5rC8f5bX"
-        self.database_id = "8c46b8f8ad9d4dd3a299abdf84b5f98f"
-
-
-# https://greenfishblog.tistory.com/257
-def input_timer(prompt, timeout_sec):
-    import subprocess
-    import sys
-    import threading
-
-    class Local:
-        # check if timeout occurred
-        _timeout_occurred = False
-
-        def on_timeout(self, process):
-            self._timeout_occurred = True
-            process.kill()
-            # clear stdin buffer (for linux)
-            # when some keys hit and timeout occurred before enter key press,
-            # that input text passed to next input().
-            # remove stdin buffer.
-            try:
-                import termios
-                termios.tcflush(sys.stdin, termios.TCIFLUSH)
-            except ImportError:
-                # windows, just exit
-                pass
-
-        def input_timer_main(self, prompt_in, timeout_sec_in):
-            # print with no new line
-            print(prompt_in, end="")
-
-            # print prompt_in immediately
-            sys.stdout.flush()
-
-            # new python input process create.
-            # and print it for pass stdout
-            cmd = [sys.executable, '-c', 'print(input())']
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-                timer_proc = threading.Timer(timeout_sec_in, self.on_timeout, [proc])
-                try:
-                    # timer set
-                    timer_proc.start()
-                    stdout, stderr = proc.communicate()
-
-                    # get stdout and trim new line character
-                    result = stdout.decode('UTF-8').strip("\r\n")
-                finally:
-                    # timeout clear
-                    timer_proc.cancel()
-
-            # timeout check
-            if self._timeout_occurred is True:
-                # move the cursor to next line
-                print("")
-                raise TimeoutError
-            return result
-
-    t = Local()
-    return t.input_timer_main(prompt, timeout_sec)
-
-
-def input_w_timeout(str_to_print, timeout_sec=600, quit=True):
-    try:
-        title = input_timer(str_to_print, timeout_sec)
-        return title
-    except TimeoutError:
-        print(f"\nno input for {timeout_sec / 60:.0f} minutes. program exited.")
-        if quit:
-            sys.exit()
-        else:
-            pass
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    My_Auto_Book_Record = AutoBookRecord()
+    parser = argparse.ArgumentParser(description='add a book to your notion database')
+    parser.add_argument('--profile', choices=PROFILES.keys(), default=BOOK_PROFILE.name, help='target database')
+    parser.add_argument('--live', action='store_true', help='show candidates while the title is typed')
+    args = parser.parse_args()
+    My_Auto_Book_Record = AutoBookRecord(PROFILES[args.profile], args.live)
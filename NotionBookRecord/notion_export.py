@@ -0,0 +1,261 @@
+import os
+import json
+import queue
+import threading
+import argparse
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import Notion
+from data_dir import DATA_DIR
+from notion_index import COVER_KEY, get_plain_property_value
+from profiles import BOOK_PROFILE, PROFILES
+from scheduler import build_default_scheduler
+from tracing import tracer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # pyarrow is optional. only jsonl export works without it
+    pyarrow = None
+
+DEFAULT_EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
+NOTION_VERSION = '2022-06-28'
+PAGE_COLUMNS = ('page_id', 'created_time', 'last_edited_time', 'url', COVER_KEY)
+ARROW_TYPES_BY_NOTION_TYPE = {'number': 'float64', 'checkbox': 'bool_'}
+
+
+class NotionExporter:
+    # reads a whole database back into a jsonl or parquet file, page by page, never holding it all in memory.
+    # notion cursors are sequential, so the time range is split into windows that are paged through in parallel.
+    # an incremental run only reads pages edited since the last run and writes them to a file of their own
+    def __init__(self, profile, output_dir=DEFAULT_EXPORT_DIR, partitions=4, file_format='jsonl', scheduler=None,
+                 notion=None):
+        self.profile = profile
+        self.notion = notion or Notion(database_id=profile.database_id)
+        self.partitions = partitions
+        self.file_format = file_format
+        self.scheduler = scheduler or build_default_scheduler(partitions)
+        self.output_dir = os.path.join(output_dir, profile.name)
+        self.manifest_path = os.path.join(self.output_dir, 'manifest.json')
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def export(self, full=False):
+        # returns (file path, page count)
+        if self.file_format == 'parquet' and pyarrow is None:
+            raise RuntimeError('parquet export needs pyarrow. pip install pyarrow, or use jsonl')
+
+        manifest = self.load_manifest()
+        started_at = datetime.now(timezone.utc)
+        since = None if full else manifest.get('exported_until')
+        timestamp = 'created_time' if since is None else 'last_edited_time'
+        windows = self.split_time_range(timestamp, since, started_at)
+
+        kind = 'full' if since is None else 'incremental'
+        file_path = os.path.join(self.output_dir, f'{started_at.strftime("%Y%m%dT%H%M%SZ")}-{kind}.{self.file_format}')
+        writer = self.open_writer(file_path)
+        try:
+            page_count = 0
+            for page in self.read_pages_in_parallel(timestamp, windows):
+                writer.write(to_export_row(page))
+                page_count += 1
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+        # notion rounds last_edited_time down to the minute, so the next run starts a minute early.
+        # a page seen twice is harmless, readers keep the row with the latest last_edited_time
+        exported_until = (started_at - timedelta(minutes=1)).isoformat(timespec='seconds')
+        manifest['exported_until'] = exported_until
+        manifest.setdefault('files', []).append({'file': os.path.basename(file_path), 'kind': kind, 'since': since,
+                                                 'until': exported_until, 'pages': page_count})
+        self.save_manifest(manifest)
+        return file_path, page_count
+
+    def split_time_range(self, timestamp, since, until):
+        # [(on_or_after, before), ...]. a full export starts at the oldest page
+        if since is None:
+            oldest_pages = self.query_database({'page_size': 1,
+                                                'sorts': [{'timestamp': 'created_time', 'direction': 'ascending'}]})
+            if not oldest_pages['results']:
+                return []
+            since = oldest_pages['results'][0]['created_time']
+        start = datetime.fromisoformat(since.replace('Z', '+00:00'))
+        # the last window is open ended, so pages made during the export aren't lost
+        step = (until - start) / self.partitions
+        bounds = [(start + step * i).isoformat() for i in range(self.partitions)]
+        return [(bounds[i], bounds[i + 1] if i + 1 < len(bounds) else None) for i in range(len(bounds))]
+
+    def read_pages_in_parallel(self, timestamp, windows):
+        # each window is paged through by its own worker. a bounded queue hands pages over to the writer,
+        # so a slow disk makes the workers wait instead of piling pages up in memory
+        if not windows:
+            return
+        pages = queue.Queue(maxsize=len(windows) * 100)
+        finished = object()
+        stop = threading.Event()
+        with ThreadPoolExecutor(len(windows)) as executor:
+            futures = [executor.submit(self.read_window, timestamp, window, pages, finished, stop)
+                       for window in windows]
+            try:
+                finished_count = 0
+                while finished_count < len(windows):
+                    page = pages.get()
+                    if page is finished:
+                        finished_count += 1
+                        continue
+                    yield page
+            finally:
+                # the writer failed or the caller stopped reading. workers give up instead of waiting on a full queue
+                stop.set()
+            for future in futures:
+                # raises the error of a failed worker
+                future.result()
+
+    def read_window(self, timestamp, window, pages, finished, stop):
+        on_or_after, before = window
+        conditions = [{'timestamp': timestamp, timestamp: {'on_or_after': on_or_after}}]
+        if before is not None:
+            conditions.append({'timestamp': timestamp, timestamp: {'before': before}})
+        request_body = {'page_size': 100, 'filter': {'and': conditions},
+                        'sorts': [{'timestamp': timestamp, 'direction': 'ascending'}]}
+        try:
+            while not stop.is_set():
+                result = self.query_database(request_body)
+                for page in result['results']:
+                    put_until_stopped(pages, page, stop)
+                if not result.get('has_more'):
+                    return
+                request_body['start_cursor'] = result['next_cursor']
+        finally:
+            put_until_stopped(pages, finished, stop)
+
+    def query_database(self, request_body):
+        request_header = self.notion.get_request_header(notion_version=NOTION_VERSION)
+        data = json.dumps(request_body).encode('utf8')
+        with tracer.span('query_notion_database', profile=self.profile.name):
+            response = self.scheduler.request('notion', lambda: self.notion.http.post(
+                self.notion.get_database_query_url(), data=data, headers=request_header))
+        response.raise_for_status()
+        return response.json()
+
+    def get_property_types(self):
+        request_header = self.notion.get_request_header(notion_version=NOTION_VERSION)
+        response = self.scheduler.request('notion', lambda: self.notion.http.get(self.notion.get_database_url(),
+                                                                                 headers=request_header))
+        response.raise_for_status()
+        return {name: value['type'] for name, value in response.json()['properties'].items()}
+
+    def open_writer(self, file_path):
+        if self.file_format == 'parquet':
+            return ParquetPageWriter(file_path, self.get_property_types())
+        return JsonlPageWriter(file_path)
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, encoding='utf8') as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+
+class JsonlPageWriter:
+    # written to a temp file and renamed at the end, so a reader never sees half an export
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_path = f'{file_path}.tmp'
+        self.file = open(self.temp_path, 'w', encoding='utf8')
+
+    def write(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_path, self.file_path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+class ParquetPageWriter:
+    # rows are buffered up to batch_size and written as one row group, so memory stays at one batch
+    def __init__(self, file_path, property_types, batch_size=1000):
+        self.file_path = file_path
+        self.temp_path = f'{file_path}.tmp'
+        self.batch_size = batch_size
+        fields = [(name, pyarrow.string()) for name in PAGE_COLUMNS]
+        fields += [(name, getattr(pyarrow, ARROW_TYPES_BY_NOTION_TYPE.get(notion_type, 'string'))())
+                   for name, notion_type in property_types.items() if name not in PAGE_COLUMNS]
+        self.schema = pyarrow.schema(fields)
+        self.rows = []
+        self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, self.schema)
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            columns = {name: [to_column_value(row.get(name), self.schema.field(name).type) for row in self.rows]
+                       for name in self.schema.names}
+            self.writer.write_table(pyarrow.table(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.temp_path, self.file_path)
+
+    def abort(self):
+        self.writer.close()
+        os.remove(self.temp_path)
+
+
+def put_until_stopped(pages, page, stop):
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+
+def to_column_value(value, arrow_type):
+    if value is None or arrow_type != pyarrow.string() or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def to_export_row(page):
+    # the page as plain values, same shape as the snapshots of NotionIndex
+    row = {'page_id': page['id'], 'created_time': page['created_time'], 'last_edited_time': page['last_edited_time'],
+           'url': page.get('url')}
+    cover = page.get('cover')
+    row[COVER_KEY] = cover[cover['type']]['url'] if cover else None
+    for name, value in page['properties'].items():
+        row[name] = get_plain_property_value(value)
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export your notion database to a jsonl or parquet file')
+    parser.add_argument('--profile', choices=PROFILES.keys(), default=BOOK_PROFILE.name, help='database to export')
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl')
+    parser.add_argument('--full', action='store_true', help='export every page, not only the ones edited since '
+                                                            'the last export')
+    parser.add_argument('--partitions', type=int, default=4, help='number of time windows read at once')
+    parser.add_argument('--output-dir', default=DEFAULT_EXPORT_DIR)
+    args = parser.parse_args()
+
+    My_Notion_Exporter = NotionExporter(PROFILES[args.profile], args.output_dir, args.partitions, args.format)
+    exported_file_path, exported_page_count = My_Notion_Exporter.export(args.full)
+    print(f'{exported_page_count} pages exported to {exported_file_path}')
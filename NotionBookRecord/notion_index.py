@@ -0,0 +1,234 @@
+import os
+import json
+import sqlite3
+import threading
+from urllib.parse import urlparse, parse_qs
+
+from data_dir import DATA_DIR
+
+DEFAULT_INDEX_PATH = os.path.join(DATA_DIR, 'notion_index.sqlite3')
+# page cover is kept in a snapshot under this key, next to the properties
+COVER_KEY = '@cover'
+
+
+class NotionIndex:
+    # local copy of (page id, title, aladin link, isbn) of every page in the database.
+    # duplicate check is a dict lookup and only pages edited after the last sync are fetched again
+    def __init__(self, notion, db_path=DEFAULT_INDEX_PATH, scheduler=None):
+        self.notion = notion
+        # queries wait for the notion bucket of the scheduler and are retried after a 429 like any other request
+        self.scheduler = scheduler
+        self.database_id = notion.database_id
+        self.lock = threading.Lock()
+        self.page_id_by_key = {}
+        # shared by the processes of a sharded import. wal and a busy timeout keep them from failing
+        # with 'database is locked' while another one writes
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS notion_page ('
+                                'page_id TEXT PRIMARY KEY, database_id TEXT NOT NULL, title_key TEXT, '
+                                'link_key TEXT, isbn TEXT, last_edited_time TEXT, snapshot TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS notion_sync_state ('
+                                'database_id TEXT PRIMARY KEY, last_edited_time TEXT)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(notion_page)')]
+        if 'snapshot' not in columns:
+            # index made before snapshots were kept
+            self.connection.execute('ALTER TABLE notion_page ADD COLUMN snapshot TEXT')
+        self.connection.commit()
+        self.load_index()
+
+    def load_index(self):
+        rows = self.connection.execute('SELECT page_id, title_key, link_key, isbn FROM notion_page '
+                                       'WHERE database_id = ?', (self.database_id,))
+        for page_id, title_key, link_key, isbn in rows:
+            self.add_keys(page_id, title_key, link_key, isbn)
+
+    def add_keys(self, page_id, title_key, link_key, isbn):
+        for key in build_index_keys(title_key, link_key, isbn):
+            self.page_id_by_key[key] = page_id
+
+    def sync(self):
+        last_synced_time = self.get_last_synced_time()
+        synced_count = 0
+        for page in self.query_pages_edited_since(last_synced_time):
+            self.add_page_from_notion(page)
+            last_synced_time = max(last_synced_time or '', page['last_edited_time'])
+            synced_count += 1
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO notion_sync_state VALUES (?, ?)',
+                                    (self.database_id, last_synced_time))
+            self.connection.commit()
+        return synced_count
+
+    def full_resync(self):
+        # pages deleted on notion are only dropped by a full resync
+        with self.lock:
+            self.connection.execute('DELETE FROM notion_page WHERE database_id = ?', (self.database_id,))
+            self.connection.execute('DELETE FROM notion_sync_state WHERE database_id = ?', (self.database_id,))
+            self.connection.commit()
+            self.page_id_by_key = {}
+        return self.sync()
+
+    def get_last_synced_time(self):
+        row = self.connection.execute('SELECT last_edited_time FROM notion_sync_state WHERE database_id = ?',
+                                      (self.database_id,)).fetchone()
+        return row[0] if row else None
+
+    def query_pages_edited_since(self, last_edited_time):
+        request_body = {'page_size': 100,
+                        'sorts': [{'timestamp': 'last_edited_time', 'direction': 'ascending'}]}
+        if last_edited_time:
+            # notion rounds last_edited_time to the minute, so pages of the same minute come again. it's harmless
+            request_body['filter'] = {'timestamp': 'last_edited_time',
+                                      'last_edited_time': {'on_or_after': last_edited_time}}
+
+        request_header = self.notion.get_request_header(notion_version='2022-06-28')
+        while True:
+            send = lambda: self.notion.http.post(self.notion.get_database_query_url(),
+                                                 data=json.dumps(request_body).encode('utf8'), headers=request_header)
+            response = send() if self.scheduler is None else self.scheduler.request('notion', send)
+            response.raise_for_status()
+            result = response.json()
+            yield from result['results']
+            if not result.get('has_more'):
+                return
+            request_body['start_cursor'] = result['next_cursor']
+
+    def add_page_from_notion(self, page):
+        if page.get('archived'):
+            self.remove_page(page['id'])
+            return
+        properties = page['properties']
+        self.add_page(page['id'], get_title_property(properties), get_url_property(properties),
+                      get_isbn_property(properties), page['last_edited_time'], build_page_snapshot(page))
+
+    def add_page(self, page_id, title, info_url, isbn=None, last_edited_time=None, snapshot=None):
+        title_key, link_key = normalize_title(title), normalize_link(info_url)
+        snapshot_json = json.dumps(snapshot, ensure_ascii=False) if snapshot is not None else None
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO notion_page VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (page_id, self.database_id, title_key, link_key, isbn, last_edited_time,
+                                     snapshot_json))
+            self.connection.commit()
+            self.add_keys(page_id, title_key, link_key, isbn)
+
+    def get_snapshot(self, page_id):
+        # {property name: plain value} of the page as we last saw it. read from disk, not kept in memory.
+        # None when it was never seen, like pages indexed before snapshots were kept
+        with self.lock:
+            row = self.connection.execute('SELECT snapshot FROM notion_page WHERE page_id = ?', (page_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def update_snapshot(self, page_id, values):
+        snapshot = self.get_snapshot(page_id) or {}
+        snapshot.update(values)
+        with self.lock:
+            self.connection.execute('UPDATE notion_page SET snapshot = ? WHERE page_id = ?',
+                                    (json.dumps(snapshot, ensure_ascii=False), page_id))
+            self.connection.commit()
+
+    def remove_page(self, page_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM notion_page WHERE page_id = ?', (page_id,))
+            self.connection.commit()
+            self.page_id_by_key = {key: value for key, value in self.page_id_by_key.items() if value != page_id}
+
+    def find_duplicate(self, title, info_url, isbn=None):
+        for key in build_index_keys(normalize_title(title), normalize_link(info_url), isbn):
+            page_id = self.page_id_by_key.get(key)
+            if page_id is not None:
+                return page_id
+        return None
+
+    def reserve(self, title, info_url, isbn=None):
+        # check and mark at once, so the same book in two rows of a bulk import isn't posted twice
+        with self.lock:
+            keys = build_index_keys(normalize_title(title), normalize_link(info_url), isbn)
+            if any(key in self.page_id_by_key for key in keys):
+                return False
+            for key in keys:
+                self.page_id_by_key[key] = None
+            return True
+
+    def release(self, title, info_url, isbn=None):
+        with self.lock:
+            for key in build_index_keys(normalize_title(title), normalize_link(info_url), isbn):
+                if key in self.page_id_by_key and self.page_id_by_key[key] is None:
+                    del self.page_id_by_key[key]
+
+
+def build_index_keys(title_key, link_key, isbn):
+    keys = []
+    if link_key:
+        keys.append('link:' + link_key)
+    if isbn:
+        keys.append('isbn:' + isbn)
+    if title_key:
+        keys.append('title:' + title_key)
+    return keys
+
+
+def normalize_title(title):
+    return ''.join((title or '').lower().split())
+
+
+def normalize_link(info_url):
+    # same aladin item has links with different partner params
+    if not info_url:
+        return ''
+    item_id = parse_qs(urlparse(info_url).query).get('ItemId')
+    if item_id:
+        return 'aladin:' + item_id[0]
+    return info_url
+
+
+def get_title_property(properties):
+    for value in properties.values():
+        if value['type'] == 'title':
+            return ''.join(text['plain_text'] for text in value['title'])
+    return ''
+
+
+def get_url_property(properties):
+    for value in properties.values():
+        if value['type'] == 'url' and value['url']:
+            return value['url']
+    return ''
+
+
+def build_page_snapshot(page):
+    snapshot = {name: get_plain_property_value(value) for name, value in page['properties'].items()}
+    cover = page.get('cover')
+    if cover:
+        snapshot[COVER_KEY] = cover[cover['type']]['url']
+    return snapshot
+
+
+def get_plain_property_value(value):
+    # same shape as the values we write, so a snapshot and a record can be compared directly
+    notion_type = value['type']
+    if notion_type in ('title', 'rich_text'):
+        return ''.join(text['plain_text'] for text in value[notion_type])
+    if notion_type == 'select':
+        return value['select']['name'] if value['select'] else None
+    if notion_type == 'multi_select':
+        return ', '.join(option['name'] for option in value['multi_select'])
+    if notion_type == 'date':
+        return value['date']['start'] if value['date'] else None
+    if notion_type in ('url', 'number', 'checkbox', 'email', 'phone_number'):
+        return value[notion_type]
+    return None
+
+
+def get_isbn_property(properties):
+    value = properties.get('ISBN')
+    if value is None:
+        return None
+    if value['type'] == 'rich_text':
+        return ''.join(text['plain_text'] for text in value['rich_text']) or None
+    if value['type'] == 'number' and value['number'] is not None:
+        return str(value['number'])
+    return None
@@ -0,0 +1,54 @@
+import threading
+
+
+class PageUpdateBatch:
+    # updates for existing pages are staged here first. several updates of the same page become one PATCH
+    # carrying only the properties that differ from the page snapshot
+    def __init__(self, engine):
+        self.engine = engine
+        self.pending_values = {}
+        self.lock = threading.Lock()
+
+    def stage(self, page_id, values):
+        changed_values = self.diff_with_snapshot(page_id, values)
+        if not changed_values:
+            return 0
+        with self.lock:
+            self.pending_values.setdefault(page_id, {}).update(changed_values)
+        return len(changed_values)
+
+    def diff_with_snapshot(self, page_id, values):
+        snapshot = self.engine.notion_index.get_snapshot(page_id)
+        if snapshot is None:
+            # the page is read once, so a value the user filled in isn't taken for a missing one
+            snapshot = self.engine.fetch_page_snapshot(page_id)
+        keep_existing = self.engine.profile.keep_existing
+        changed_values = {}
+        for name, value in values.items():
+            if name in keep_existing and (snapshot is None or snapshot.get(name)):
+                # a page we couldn't read might have it filled, so it's left alone
+                continue
+            if snapshot is None or name not in snapshot or snapshot[name] != value:
+                changed_values[name] = value
+        return changed_values
+
+    def flush(self):
+        # returns (updated page count, failed page count)
+        with self.lock:
+            pending_values, self.pending_values = self.pending_values, {}
+
+        updated_count, failed_count = 0, 0
+        for page_id, values in pending_values.items():
+            try:
+                response = self.engine.send_notion_page_patch(page_id, values)
+            except Exception:
+                response = None
+            if response is not None and response.status_code == 200:
+                self.engine.notion_index.update_snapshot(page_id, values)
+                updated_count += 1
+            else:
+                failed_count += 1
+        return updated_count, failed_count
+
+    def __len__(self):
+        return len(self.pending_values)
@@ -0,0 +1,203 @@
+from aladin_decoder import decode_item_list
+from book_search_index import rank_items, get_confidence
+from clients import Aladin, Notion, is_connect_error
+from cover_store import get_shared_cover_store
+from notion_index import NotionIndex
+from notion_upsert import PageUpdateBatch
+from post_queue import PostQueue
+from tracing import tracer
+
+
+class BookRecordEngine:
+    # aladin lookup -> record -> notion page for one database profile. no prompt and no print,
+    # so the interactive script, bulk import and others share it
+    def __init__(self, profile, aladin=None, notion=None, scheduler=None, notion_index=None, post_queue=None,
+                 cover_store=None):
+        self.profile = profile
+        self.aladin = aladin or Aladin()
+        self.notion = notion or Notion(database_id=profile.database_id)
+        self.payload_template = profile.compile()
+        self.scheduler = scheduler
+        self.notion_index = notion_index or NotionIndex(self.notion, scheduler=scheduler)
+        self.update_batch = PageUpdateBatch(self)
+        self.post_queue = post_queue or PostQueue()
+        self.cover_store = cover_store or get_shared_cover_store()
+
+    def send_request(self, backend, send, idempotent=True):
+        if self.scheduler is None:
+            return send()
+        return self.scheduler.request(backend, send, idempotent)
+
+    def search_book_info(self, title, page=1):
+        # same query is served from local cache instead of spending ttb quota again
+        cached_result = self.get_cached_book_info(title, page)
+        if cached_result is not None:
+            return cached_result
+
+        result = self.trim_response_to_json(self.request_book_info(title, page))
+        if len(result) > 0:
+            self.aladin.cache.put(title, self.get_search_cache_version(), result, page)
+            self.aladin.search_index.add_items(result)
+        return result
+
+    def get_cached_book_info(self, title, page=1, count=True):
+        # None when the query was never searched. never asks aladin
+        return self.aladin.cache.get(title, self.get_search_cache_version(), page, count)
+
+    def search_local_book_info(self, title, min_confidence=0.9):
+        # candidates from every item fetched before, best match first, in a few ms and without aladin.
+        # None when nothing local matches well enough to skip asking aladin
+        with tracer.span('search_local_index') as span:
+            ranked_items = self.aladin.search_index.search(title, self.aladin.max_results)
+            confidence = get_confidence(ranked_items)
+            span.set(results=len(ranked_items), confidence=round(confidence, 3))
+        if not ranked_items or confidence < min_confidence:
+            return None
+        return [item for _, item in ranked_items]
+
+    def rank_candidates(self, title, item_list):
+        # aladin's own order, re-sorted by how close each item is to what was typed
+        return [item for _, item in rank_items(title, item_list)]
+
+    def get_search_cache_version(self):
+        return f'{self.aladin.api_version}-{self.aladin.max_results}'
+
+    def lookup_book_info_by_isbn(self, isbn):
+        isbn = isbn.replace('-', '')
+        cached_result = self.aladin.cache.get('isbn:' + isbn, self.aladin.api_version)
+        if cached_result is not None:
+            return cached_result
+
+        response = self.request_book_info_by_isbn(isbn)
+        with tracer.span('trim_response_to_json'):
+            result = decode_item_list(response.content, missing_ok=True)
+        if len(result) > 0:
+            self.aladin.cache.put('isbn:' + isbn, self.aladin.api_version, result)
+            self.aladin.search_index.add_items(result)
+        return result
+
+    def request_book_info_by_isbn(self, isbn):
+        params = {'TTBKey': self.aladin.ttb_key, 'ItemId': isbn, 'ItemIdType': 'ISBN13' if len(isbn) == 13 else 'ISBN',
+                  'Output': 'JS', 'Version': self.aladin.api_version, 'Cover': 'Big'}
+        with tracer.span('request_book_info', lookup='isbn'):
+            return self.send_request('aladin', lambda: self.aladin.http.get(self.aladin.lookup_url, params=params))
+
+    def request_book_info(self, title, page=1):
+        params = {'TTBKey': self.aladin.ttb_key, 'Query': title, 'Output': 'JS', 'Version': self.aladin.api_version,
+                  'Cover': 'Big', 'MaxResults': self.aladin.max_results, 'Start': page}
+        with tracer.span('request_book_info', lookup='search', page=page):
+            return self.send_request('aladin', lambda: self.aladin.http.get(self.aladin.request_url, params=params))
+
+    def trim_response_to_json(self, raw_response):
+        # parsed from bytes, and only the fields we use are kept
+        with tracer.span('trim_response_to_json', response_bytes=len(raw_response.content)):
+            return decode_item_list(raw_response.content)
+
+    def prefetch_covers(self, item_list):
+        if self.cover_store is not None:
+            self.cover_store.prefetch(item['cover'] for item in item_list)
+
+    def build_book(self, item):
+        with tracer.span('set_book_configuration', profile=self.profile.name):
+            book = self.profile.build_record(item)
+        if self.cover_store is not None and isinstance(self.profile.cover, str):
+            # mirrored cover instead of the aladin cdn, if it's downloaded in time
+            with tracer.span('get_cover_url'):
+                cover_url = self.cover_store.get_cover_url(getattr(book, self.profile.cover))
+                book = book._replace(**{self.profile.cover: cover_url})
+        return book
+
+    def enqueue_book_post(self, book, idempotency_key, isbn=None):
+        # the page body is rendered now, so a resumed job posts exactly what was resolved
+        return self.post_queue.enqueue(idempotency_key, self.profile.name, book.title, book.info_url, isbn,
+                                       self.trim_book_info_to_json(book), self.payload_template.get_values(book))
+
+    def post_book_through_queue(self, book, idempotency_key, isbn=None):
+        # returns 'added', 'queued'(tried again with backoff later), 'post_failed', or 'post_in_flight' when the job
+        # is being posted by someone else or was cut off mid-flight. recover_in_flight() makes the latter pending again
+        status = self.enqueue_book_post(book, idempotency_key, isbn)
+        if status == 'done':
+            return 'added'
+        if status == 'dead':
+            return 'post_failed'
+        result = self.post_queued_book(idempotency_key) if status == 'pending' else None
+        if result is None:
+            return 'post_in_flight'
+        if result == 'dead':
+            return 'post_failed'
+        return 'added' if result == 'added' else 'queued'
+
+    def post_queued_book(self, idempotency_key):
+        # returns 'added', 'pending'(tried again later), 'dead', or None when the job isn't waiting to be posted
+        job = self.post_queue.claim(idempotency_key)
+        if job is None:
+            return None
+        return self.send_queued_post(job)
+
+    def send_queued_post(self, job):
+        key = job['idempotency_key']
+        if job['in_doubt']:
+            # the page might have been created by the attempt in doubt. it's in the index once synced
+            try:
+                self.notion_index.sync()
+            except Exception as e:
+                return self.post_queue.mark_failed(key, f'sync before retry: {e!r}', in_doubt=True)
+            page_id = self.notion_index.find_duplicate(job['title'], job['info_url'], job['isbn'])
+            if page_id is not None:
+                self.post_queue.mark_done(key, page_id)
+                return 'added'
+
+        request_header = self.notion.get_request_header()
+        with tracer.span('request_notion_database_post', attempt=job['attempts'] + 1) as span:
+            try:
+                response = self.send_request('notion', lambda: self.notion.http.post(self.notion.request_url,
+                                                                                     data=job['body'],
+                                                                                     headers=request_header),
+                                             idempotent=False)
+            except Exception as e:
+                span.status = 'error'
+                return self.post_queue.mark_failed(key, repr(e), in_doubt=not is_connect_error(e))
+            span.set(status_code=response.status_code)
+
+        if response.status_code == 200:
+            page_id = response.json()['id']
+            self.notion_index.add_page(page_id, job['title'], job['info_url'], job['isbn'], snapshot=job['snapshot'])
+            self.post_queue.mark_done(key, page_id)
+            return 'added'
+        # a 4xx other than 429 fails the same way every time. a 5xx might come after the page was created
+        permanent = 400 <= response.status_code < 500 and response.status_code != 429
+        return self.post_queue.mark_failed(key, f'{response.status_code} {response.text[:200]}', permanent,
+                                           in_doubt=response.status_code >= 500)
+
+    def stage_book_update(self, page_id, book):
+        if self.update_batch.stage(page_id, self.payload_template.get_values(book)) == 0:
+            return 'unchanged'
+        return 'updated'
+
+    def send_notion_page_patch(self, page_id, values):
+        request_header = self.notion.get_request_header(notion_version='2022-06-28')
+        request_body = self.payload_template.render_update(values)
+        with tracer.span('update_notion_page', properties=len(values)):
+            return self.send_request('notion', lambda: self.notion.http.patch(self.notion.get_page_url(page_id),
+                                                                              data=request_body,
+                                                                              headers=request_header))
+
+    def fetch_page_snapshot(self, page_id):
+        # a page indexed without its snapshot is read from notion and indexed again. None when it can't be read
+        request_header = self.notion.get_request_header(notion_version='2022-06-28')
+        with tracer.span('fetch_notion_page') as span:
+            try:
+                response = self.send_request('notion', lambda: self.notion.http.get(self.notion.get_page_url(page_id),
+                                                                                    headers=request_header))
+            except Exception:
+                span.status = 'error'
+                return None
+            span.set(status_code=response.status_code)
+        if response.status_code != 200:
+            return None
+        self.notion_index.add_page_from_notion(response.json())
+        return self.notion_index.get_snapshot(page_id)
+
+    def trim_book_info_to_json(self, book):
+        with tracer.span('trim_book_info_to_json'):
+            return self.payload_template.render(book)
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from data_dir import DATA_DIR
+
+DEFAULT_QUEUE_PATH = os.path.join(DATA_DIR, 'post_queue.sqlite3')
+
+JOB_COLUMNS = ('idempotency_key', 'profile', 'title', 'info_url', 'isbn', 'body', 'snapshot', 'status', 'attempts',
+               'next_attempt_at', 'in_doubt', 'last_error', 'page_id', 'created_at')
+
+
+class PostQueue:
+    # every notion page post is written here before it is sent, so a crash or a network outage loses nothing.
+    # a failed post is tried again with exponential backoff, and moved to post_dead_letter after max_attempts.
+    # the idempotency key makes the same book of the same job queued only once, however often it is resolved
+    def __init__(self, db_path=DEFAULT_QUEUE_PATH, max_attempts=8, backoff_sec=2, max_backoff_sec=600):
+        self.max_attempts = max_attempts
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS post_job ('
+                                'idempotency_key TEXT PRIMARY KEY, profile TEXT NOT NULL, title TEXT, info_url TEXT, '
+                                'isbn TEXT, body BLOB NOT NULL, snapshot TEXT, status TEXT NOT NULL, '
+                                'attempts INTEGER NOT NULL, next_attempt_at REAL NOT NULL, in_doubt INTEGER NOT NULL, '
+                                'last_error TEXT, page_id TEXT, created_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS post_job_status ON post_job (status, next_attempt_at)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS post_dead_letter ('
+                                'idempotency_key TEXT PRIMARY KEY, profile TEXT NOT NULL, title TEXT, info_url TEXT, '
+                                'isbn TEXT, body BLOB NOT NULL, snapshot TEXT, attempts INTEGER NOT NULL, '
+                                'last_error TEXT, failed_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bulk_job ('
+                                'job_name TEXT PRIMARY KEY, file_path TEXT NOT NULL, started_at REAL NOT NULL)')
+        # result of every input row of a bulk import, so a resumed job starts after the last row handled
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bulk_row ('
+                                'job_name TEXT NOT NULL, line_num INTEGER NOT NULL, title TEXT, isbn TEXT, '
+                                'profile TEXT, result TEXT NOT NULL, PRIMARY KEY (job_name, line_num))')
+        self.connection.commit()
+
+    def enqueue(self, idempotency_key, profile_name, title, info_url, isbn, body, snapshot):
+        # returns the status of the job with this key. a key already queued or done is left as it is
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO post_job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (idempotency_key, profile_name, title, info_url, isbn, body,
+                                     json.dumps(snapshot, ensure_ascii=False), 'pending', 0, 0, 0, None, None,
+                                     time.time()))
+            self.connection.commit()
+            row = self.connection.execute('SELECT status FROM post_job WHERE idempotency_key = ?',
+                                          (idempotency_key,)).fetchone()
+        return row[0] if row else 'dead'
+
+    def claim(self, idempotency_key):
+        # pending -> in_flight. only one caller gets the job
+        with self.lock:
+            cursor = self.connection.execute("UPDATE post_job SET status = 'in_flight' "
+                                             "WHERE idempotency_key = ? AND status = 'pending'", (idempotency_key,))
+            self.connection.commit()
+            if cursor.rowcount != 1:
+                return None
+            row = self.connection.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM post_job WHERE idempotency_key = ?',
+                                          (idempotency_key,)).fetchone()
+        return to_job(row)
+
+    def claim_due_jobs(self, profile_name=None, limit=100):
+        rows = self.connection.execute("SELECT idempotency_key FROM post_job WHERE status = 'pending' "
+                                       "AND next_attempt_at <= ? AND profile = IFNULL(?, profile) "
+                                       "ORDER BY created_at LIMIT ?", (time.time(), profile_name, limit)).fetchall()
+        return [job for job in (self.claim(row[0]) for row in rows) if job is not None]
+
+    def mark_done(self, idempotency_key, page_id):
+        with self.lock:
+            self.connection.execute("UPDATE post_job SET status = 'done', page_id = ?, body = x'', in_doubt = 0 "
+                                    "WHERE idempotency_key = ?", (page_id, idempotency_key))
+            self.connection.commit()
+
+    def mark_failed(self, idempotency_key, error, permanent=False, in_doubt=False):
+        # returns 'pending' when the job will be tried again, or 'dead'. in_doubt when notion might have
+        # created the page anyway, like after a read timeout
+        with self.lock:
+            self.connection.execute('UPDATE post_job SET attempts = attempts + 1, last_error = ?, in_doubt = ? '
+                                    'WHERE idempotency_key = ?', (error, int(in_doubt), idempotency_key))
+            attempts = self.connection.execute('SELECT attempts FROM post_job WHERE idempotency_key = ?',
+                                               (idempotency_key,)).fetchone()[0]
+            if permanent or attempts >= self.max_attempts:
+                self.connection.execute('INSERT OR REPLACE INTO post_dead_letter '
+                                        'SELECT idempotency_key, profile, title, info_url, isbn, body, snapshot, '
+                                        'attempts, last_error, ? FROM post_job WHERE idempotency_key = ?',
+                                        (time.time(), idempotency_key))
+                self.connection.execute('DELETE FROM post_job WHERE idempotency_key = ?', (idempotency_key,))
+                self.connection.commit()
+                return 'dead'
+
+            delay_sec = min(self.max_backoff_sec, self.backoff_sec * 2 ** (attempts - 1))
+            self.connection.execute("UPDATE post_job SET status = 'pending', next_attempt_at = ? "
+                                    "WHERE idempotency_key = ?", (time.time() + delay_sec, idempotency_key))
+            self.connection.commit()
+            return 'pending'
+
+    def recover_in_flight(self, profile_name=None):
+        # jobs left in_flight by a crashed run. notion might have created the page already,
+        # so they are marked in_doubt and checked against the notion index before posting again
+        with self.lock:
+            cursor = self.connection.execute("UPDATE post_job SET status = 'pending', in_doubt = 1 "
+                                             "WHERE status = 'in_flight' AND profile = IFNULL(?, profile)",
+                                             (profile_name,))
+            self.connection.commit()
+        return cursor.rowcount
+
+    def make_pending_due(self, profile_name=None):
+        # a new run doesn't wait for the backoff left by the previous one
+        with self.lock:
+            self.connection.execute("UPDATE post_job SET next_attempt_at = 0 WHERE status = 'pending' "
+                                    "AND profile = IFNULL(?, profile)", (profile_name,))
+            self.connection.commit()
+
+    def requeue_dead_letters(self):
+        with self.lock:
+            cursor = self.connection.execute("INSERT OR REPLACE INTO post_job "
+                                             "SELECT idempotency_key, profile, title, info_url, isbn, body, snapshot, "
+                                             "'pending', 0, 0, 0, last_error, NULL, ? FROM post_dead_letter",
+                                             (time.time(),))
+            self.connection.execute('DELETE FROM post_dead_letter')
+            self.connection.commit()
+        return cursor.rowcount
+
+    def get_pending_jobs(self, profile_name=None):
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM post_job WHERE status = 'pending' "
+                                           f"AND profile = IFNULL(?, profile)", (profile_name,)).fetchall()
+        return [to_job(row) for row in rows]
+
+    def get_next_attempt_at(self):
+        row = self.connection.execute("SELECT MIN(next_attempt_at) FROM post_job WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def get_profile_names(self):
+        rows = self.connection.execute("SELECT DISTINCT profile FROM post_job WHERE status != 'done'")
+        return [row[0] for row in rows]
+
+    def get_status_counts(self):
+        counts = dict(self.connection.execute('SELECT status, COUNT(*) FROM post_job GROUP BY status').fetchall())
+        counts['dead'] = self.connection.execute('SELECT COUNT(*) FROM post_dead_letter').fetchone()[0]
+        return counts
+
+    def start_bulk_job(self, file_path, resume=False):
+        # a new run of a file is a new job. resume goes on with the latest job of the file
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            if resume:
+                row = self.connection.execute('SELECT job_name FROM bulk_job WHERE file_path = ? '
+                                              'ORDER BY started_at DESC LIMIT 1', (file_path,)).fetchone()
+                if row is not None:
+                    return row[0]
+            started_at = time.time()
+            job_name = f'{file_path}@{started_at:.6f}'
+            self.connection.execute('INSERT INTO bulk_job VALUES (?, ?, ?)', (job_name, file_path, started_at))
+            self.connection.commit()
+        return job_name
+
+    def record_row_result(self, job_name, line_num, target, result):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO bulk_row VALUES (?, ?, ?, ?, ?, ?)',
+                                    (job_name, line_num, target['title'], target['isbn'], target['profile'], result))
+            self.connection.commit()
+
+    def get_row_results(self, job_name):
+        # {line number: (target, result)} of rows already handled by this job
+        rows = self.connection.execute('SELECT line_num, title, isbn, profile, result FROM bulk_row '
+                                       'WHERE job_name = ?', (job_name,))
+        return {line_num: ({'title': title, 'isbn': isbn, 'profile': profile}, result)
+                for line_num, title, isbn, profile, result in rows}
+
+
+def to_job(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job['snapshot'] = json.loads(job['snapshot']) if job['snapshot'] else None
+    return job
+
+
+def drain_post_queue(post_queue, get_engine, scheduler=None, wait=True, profile_name=None):
+    # posts every due job. with wait, sleeps until the next backoff is over and goes on until nothing is pending.
+    # returns {'added': n, 'dead': n}
+    counts = {'added': 0, 'dead': 0}
+    while True:
+        jobs = post_queue.claim_due_jobs(profile_name)
+        if jobs:
+            send_job = lambda job: get_engine(job['profile']).send_queued_post(job)
+            results = scheduler.map_unordered(send_job, jobs) if scheduler else map(send_job, jobs)
+            for result in results:
+                if result in counts:
+                    counts[result] += 1
+            continue
+
+        next_attempt_at = post_queue.get_next_attempt_at()
+        if next_attempt_at is None or not wait:
+            return counts
+        time.sleep(max(0.0, next_attempt_at - time.time()))
+
+
+if __name__ == '__main__':
+    from pipeline import BookRecordEngine
+    from profiles import PROFILES
+
+    parser = argparse.ArgumentParser(description='notion posts waiting in the local queue')
+    parser.add_argument('command', choices=('status', 'resume', 'retry-dead'),
+                        help='status: count jobs, resume: post every queued book, '
+                             'retry-dead: move dead letters back to the queue')
+    args = parser.parse_args()
+
+    My_Post_Queue = PostQueue()
+    if args.command == 'retry-dead':
+        print(f'{My_Post_Queue.requeue_dead_letters()} dead letters queued again')
+    elif args.command == 'resume':
+        print(f'{My_Post_Queue.recover_in_flight()} posts interrupted by the last run')
+        My_Post_Queue.make_pending_due()
+        engines = {}
+        for profile_name in My_Post_Queue.get_profile_names():
+            engines[profile_name] = BookRecordEngine(PROFILES[profile_name], post_queue=My_Post_Queue)
+            engines[profile_name].notion_index.sync()
+        print(drain_post_queue(My_Post_Queue, engines.get))
+    print(My_Post_Queue.get_status_counts())
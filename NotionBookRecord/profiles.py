@@ -0,0 +1,173 @@
+import json
+from json.encoder import encode_basestring
+from operator import attrgetter
+from datetime import datetime
+from collections import namedtuple
+
+from book_normalize import get_kyobo_category, parse_author_w_translator
+from notion_index import COVER_KEY
+
+
+# records are immutable tuples without a per-instance dict, so 100k resolved books stay small.
+# a field is changed by book._replace(image=...)
+
+class Book(namedtuple('Book', ['title', 'author', 'publisher', 'translator', 'image', 'info_url', 'category'])):
+    __slots__ = ()
+
+
+class PictureBook(namedtuple('PictureBook', ['title', 'pub_date', 'author', 'publisher', 'translator', 'image',
+                                             'info_url'])):
+    __slots__ = ()
+
+
+# ------------------------ aladin item -> record ------------------------
+
+def build_book(item):
+    author, translator = parse_author_w_translator(item['author'])
+
+    return Book(
+        title=item['title'],
+        author=author,
+        publisher=item['publisher'],
+        translator=translator,
+        image=item['cover'],
+        info_url=item['link'],
+        category=get_kyobo_category(item['categoryName'])
+    )
+
+
+def build_picture_book(item):
+    author, translator = parse_author_w_translator(item['author'])
+
+    return PictureBook(
+        title=item['title'],
+        pub_date=item['pubDate'][:3],
+        author=author,
+        publisher=item['publisher'],
+        translator=translator,
+        image=item['cover'],
+        info_url=item['link']
+    )
+
+
+def get_today():
+    return datetime.now().isoformat()[:10]
+
+
+# ------------------------ record -> notion page body ------------------------
+
+PROPERTY_VALUE_BUILDERS = {
+    'title': lambda value: {"title": [{"text": {"content": value}}]},
+    'rich_text': lambda value: {"rich_text": [{"type": "text", "text": {"content": value}}]},
+    'select': lambda value: {"select": {"name": value}},
+    'url': lambda value: {"url": value},
+    'date': lambda value: {"date": {"start": value, "end": None}},
+}
+
+SLOT = '\x00slot\x00'
+
+
+class DatabaseProfile:
+    # properties is a list of (notion property name, notion property type, source).
+    # source is an attribute name of the record, or a function taking the record.
+    # keep_existing properties are written on create, but an update only fills them when the page has no value
+    def __init__(self, name, database_id, build_record, properties, cover='image', keep_existing=()):
+        self.name = name
+        self.database_id = database_id
+        self.build_record = build_record
+        self.properties = properties
+        self.cover = cover
+        self.keep_existing = set(keep_existing)
+        self.payload_template = None
+
+    def compile(self):
+        if self.payload_template is None:
+            self.payload_template = PayloadTemplate(self)
+        return self.payload_template
+
+
+class PayloadTemplate:
+    # the whole page body is serialized once with empty slots.
+    # for each book only the values are encoded and joined between the prebuilt pieces,
+    # and the joined text is encoded to utf8 once
+    def __init__(self, profile):
+        body = {"parent": {"database_id": profile.database_id},
+                "cover": {"type": "external", "external": {"url": SLOT}},
+                "properties": {name: PROPERTY_VALUE_BUILDERS[notion_type](SLOT)
+                               for name, notion_type, source in profile.properties}}
+        self.static_pieces = build_static_pieces(body)
+        # a page without cover, for a record whose cover is empty
+        del body["cover"]
+        self.static_pieces_without_cover = build_static_pieces(body)
+        self.value_getters = [to_value_getter(profile.cover)]
+        self.value_getters += [to_value_getter(source) for name, notion_type, source in profile.properties]
+        self.value_names = [COVER_KEY] + [name for name, notion_type, source in profile.properties]
+        self.property_types = {name: notion_type for name, notion_type, source in profile.properties}
+
+    def render(self, record):
+        values = [value_getter(record) for value_getter in self.value_getters]
+        static_pieces = self.static_pieces
+        if not values[0]:
+            values, static_pieces = values[1:], self.static_pieces_without_cover
+        pieces = [static_pieces[0]]
+        for value, static_piece in zip(values, static_pieces[1:]):
+            pieces.append(encode_value(value))
+            pieces.append(static_piece)
+        return ''.join(pieces).encode('utf8')
+
+    def get_values(self, record):
+        # {property name: plain value}, comparable with a page snapshot of NotionIndex
+        return {name: value_getter(record) for name, value_getter in zip(self.value_names, self.value_getters)}
+
+    def render_update(self, values):
+        body = {"properties": {name: PROPERTY_VALUE_BUILDERS[self.property_types[name]](value)
+                               for name, value in values.items() if name != COVER_KEY}}
+        if values.get(COVER_KEY):
+            body["cover"] = {"type": "external", "external": {"url": values[COVER_KEY]}}
+        return json.dumps(body, ensure_ascii=False).encode('utf8')
+
+
+def build_static_pieces(body):
+    return json.dumps(body, ensure_ascii=False).split(json.dumps(SLOT))
+
+
+def encode_value(value):
+    # the c string encoder behind json.dumps, without its per-call setup. most values are str
+    if type(value) is str:
+        return encode_basestring(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def to_value_getter(source):
+    if callable(source):
+        return source
+    return attrgetter(source)
+
+
+BOOK_PROFILE = DatabaseProfile(
+    name='book',
+    database_id="8c46b8f8ad9d4dd3a299abdf84b5f98f",
+    build_record=build_book,
+    properties=[("title", 'title', 'title'),
+                ("대분류", 'select', 'category'),
+                ("지은이", 'rich_text', 'author'),
+                ("출판사", 'rich_text', 'publisher'),
+                ("옮긴이", 'rich_text', 'translator'),
+                ("책 정보(알라딘)", 'url', 'info_url'),
+                ("읽은 날짜", 'date', lambda book: get_today())],
+    keep_existing=["대분류", "읽은 날짜"])
+
+PICTURE_BOOK_PROFILE = DatabaseProfile(
+    name='picture_book',
+    # 그림숲산책 데이터베이스 url last string
+    database_id="0abdfdf5a58341488815963dae0fa8f4",
+    build_record=build_picture_book,
+    properties=[("title", 'title', 'title'),
+                ("지은이", 'rich_text', 'author'),
+                ("출판사", 'select', 'publisher'),
+                ("번역", 'rich_text', 'translator'),
+                ("책 정보(알라딘)", 'url', 'info_url'),
+                ("진행도", 'select', lambda book: "N")],
+    keep_existing=["진행도"])
+
+PROFILES = {profile.name: profile for profile in (BOOK_PROFILE, PICTURE_BOOK_PROFILE)}
@@ -0,0 +1,179 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import date
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from clients import CONNECTION_ERRORS, get_ttb_key, is_connect_error
+from data_dir import DATA_DIR
+from tracing import tracer
+
+DEFAULT_USAGE_PATH = os.path.join(DATA_DIR, 'credential_usage.sqlite3')
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+class QuotaUsage:
+    # calls of each api key per day, kept in sqlite. every run and process using the key counts against
+    # the same quota, so two imports on one day can't spend it twice
+    def __init__(self, db_path=DEFAULT_USAGE_PATH):
+        self.lock = threading.Lock()
+        # several processes write here at once. wal lets them read while one of them writes
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS credential_usage ('
+                                'name TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, '
+                                'PRIMARY KEY (name, day))')
+        self.connection.commit()
+
+    def use(self, name, daily_quota):
+        # counts one call. False when the key has no call left today
+        today = date.today().isoformat()
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO credential_usage VALUES (?, ?, 0)', (name, today))
+            cursor = self.connection.execute('UPDATE credential_usage SET used = used + 1 '
+                                             'WHERE name = ? AND day = ? AND used < ?', (name, today, daily_quota))
+            self.connection.commit()
+        return cursor.rowcount == 1
+
+    def get_used_today(self):
+        # {key name: calls today}
+        with self.lock:
+            return dict(self.connection.execute('SELECT name, used FROM credential_usage WHERE day = ?',
+                                                (date.today().isoformat(),)))
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec, capacity=None, daily_quota=None, quota_usage=None, quota_name=None):
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity or max(1, rate_per_sec)
+        self.daily_quota = daily_quota
+        # with quota_usage the daily quota is counted on disk under quota_name, across runs and processes
+        self.quota_usage = quota_usage
+        self.quota_name = quota_name
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.used_today = 0
+        self.today = date.today()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.use_daily_quota()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    return
+                wait_sec = max(self.paused_until - now, (1 - self.tokens) / self.rate_per_sec)
+            time.sleep(wait_sec)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_sec)
+        self.updated_at = now
+
+    def use_daily_quota(self):
+        if self.daily_quota is None:
+            return
+        if self.quota_usage is not None:
+            if not self.quota_usage.use(self.quota_name, self.daily_quota):
+                raise QuotaExceededError(f'daily quota {self.daily_quota} is used up')
+            return
+        with self.lock:
+            if self.today != date.today():
+                self.today = date.today()
+                self.used_today = 0
+            if self.used_today >= self.daily_quota:
+                raise QuotaExceededError(f'daily quota {self.daily_quota} is used up')
+
+    def pause(self, seconds):
+        # every caller of this bucket waits, not only the one who got 429
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class RateLimitedScheduler:
+    retry_status_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_workers=8, max_retries=5, backoff_sec=1):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.buckets = {}
+        self.retry_count = 0
+
+    def add_backend(self, name, bucket):
+        self.buckets[name] = bucket
+
+    def request(self, backend, send, idempotent=True):
+        # send is a function doing one http call and returning its response. a request that isn't idempotent,
+        # like creating a page, is sent again only after a 429 or when it never reached the server. after a read
+        # timeout or a 5xx the server might have done it already, so that's left to the caller
+        bucket = self.buckets[backend]
+        for attempt in range(self.max_retries + 1):
+            with tracer.span(f'rate_limit_wait_{backend}'):
+                bucket.acquire()
+            try:
+                response = send()
+            except CONNECTION_ERRORS as e:
+                if attempt == self.max_retries or not (idempotent or is_connect_error(e)):
+                    raise
+                self.retry_count += 1
+                tracer.record_retry(backend, 'connection')
+                time.sleep(self.backoff_sec * 2 ** attempt)
+                continue
+
+            if response.status_code not in self.retry_status_codes or attempt == self.max_retries:
+                return response
+            if not idempotent and response.status_code != 429:
+                return response
+            self.retry_count += 1
+            tracer.record_retry(backend, str(response.status_code))
+            bucket.pause(get_retry_after_sec(response) or self.backoff_sec * 2 ** attempt)
+        return response
+
+    def map_unordered(self, fn, iterable):
+        # keeps only a few tasks in flight so a huge input is streamed, not loaded at once
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            in_flight = set()
+            for item in iterable:
+                in_flight.add(executor.submit(fn, item))
+                if len(in_flight) >= self.max_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in in_flight:
+                yield future.result()
+
+
+def get_retry_after_sec(response):
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def build_default_scheduler(max_workers=8, notion_rate_per_sec=3, aladin_rate_per_sec=10, aladin_daily_quota=5000,
+                            quota_usage=None):
+    scheduler = RateLimitedScheduler(max_workers)
+    # notion allows average 3 requests per second for an integration
+    scheduler.add_backend('notion', TokenBucket(rate_per_sec=notion_rate_per_sec))
+    # aladin ttb key can call 5,000 times a day, counted for the key over every run of the day
+    scheduler.add_backend('aladin', TokenBucket(rate_per_sec=aladin_rate_per_sec, daily_quota=aladin_daily_quota,
+                                                quota_usage=quota_usage or QuotaUsage(), quota_name=get_ttb_key()))
+    return scheduler
@@ -0,0 +1,47 @@
+import time
+from contextlib import contextmanager
+
+
+class SessionStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.books_added = 0
+        self.books_queued = 0
+        self.books_failed = 0
+        # stage name -> [count, total sec, max sec]. only sums are kept, so memory stays flat in a long session
+        self.stage_timings = {}
+
+    @contextmanager
+    def measure(self, stage):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage_timing(stage, time.monotonic() - started_at)
+
+    def add_stage_timing(self, stage, elapsed_sec):
+        timing = self.stage_timings.setdefault(stage, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed_sec
+        timing[2] = max(timing[2], elapsed_sec)
+
+    def add_result(self, result):
+        # 'added', 'queued'(added once notion can be reached) or anything else for a failure
+        if result == 'added':
+            self.books_added += 1
+        elif result == 'queued':
+            self.books_queued += 1
+        else:
+            self.books_failed += 1
+
+    def get_elapsed_sec(self):
+        return time.monotonic() - self.started_at
+
+    def get_books_per_hour(self):
+        return self.books_added / max(self.get_elapsed_sec(), 1) * 60 * 60
+
+    def print_summary(self):
+        print(f'\n{self.books_added} books added, {self.books_queued} queued, {self.books_failed} failed '
+              f'in {self.get_elapsed_sec() / 60:.1f} minutes ({self.get_books_per_hour():.1f} books/hour)')
+        for stage, (count, total_sec, max_sec) in self.stage_timings.items():
+            print(f'   {stage}: {count} times, avg {total_sec / count:.3f} sec, max {max_sec:.3f} sec')
@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from functools import partial
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from bulk_import import (BulkBookRecord, BulkImportReport, CHOOSERS, RETRYABLE_RESULTS, choose_by_rank,
+                         read_target_book_list)
+from clients import Notion
+from credential_pool import CredentialPool, PooledQuotaBucket, DEFAULT_CREDENTIALS_PATH
+from data_dir import DATA_DIR
+from notion_index import NotionIndex, normalize_title
+from post_queue import PostQueue, drain_post_queue
+from profiles import BOOK_PROFILE, PROFILES
+from scheduler import RateLimitedScheduler, TokenBucket, build_default_scheduler
+from tracing import tracer
+
+DEFAULT_WORK_TABLE_PATH = os.path.join(DATA_DIR, 'sharded_import.sqlite3')
+
+
+class ShardedBulkImport:
+    # bulk_import over several processes, each with its own aladin key and notion token from a credential pool,
+    # so a big catalog isn't capped by the quota of one key and the rate limit of one integration.
+    # rows are put in a work table once and split into shards, one per process. a process takes rows of its own
+    # shard first and then steals rows nobody took yet, so a process whose key is used up doesn't hold any back
+    def __init__(self, file_path, credentials_path=DEFAULT_CREDENTIALS_PATH, processes=None, threads=4, resume=False,
+                 options=None):
+        self.file_path = file_path
+        self.credentials_path = credentials_path
+        self.credential_pool = CredentialPool(credentials_path)
+        self.threads = threads
+        # bulk_import options, passed to every worker as they are
+        self.options = options or {}
+        self.work_table = WorkTable()
+        self.report = BulkImportReport(file_path)
+        self.execute_sharded_import(file_path, processes, resume)
+
+    def execute_sharded_import(self, file_path, processes, resume):
+        available_keys = self.credential_pool.get_available_aladin_keys()
+        if not available_keys:
+            print('every aladin key of the pool is used up for today.')
+            return
+        # one process per aladin key with calls left, unless told otherwise
+        processes = processes or len(available_keys)
+        self.job_name, is_new_job = self.work_table.start_job(file_path, processes, resume)
+        if is_new_job:
+            profile_names = self.work_table.add_rows(self.job_name, read_target_book_list(file_path), processes,
+                                                     self.options.get('default_profile', BOOK_PROFILE.name),
+                                                     self.options.get('skip_duplicates', True))
+            self.sync_notion_indexes(profile_names)
+        else:
+            # posts cut off by a worker that died are checked against the index and sent again, not taken as done
+            print(f'{PostQueue().recover_in_flight()} posts were interrupted')
+
+        worker_summaries = self.run_workers(processes, available_keys)
+        # rows still claimed belong to a worker that stopped on an error. they go back to pending for --resume
+        failed_line_nums = self.work_table.release_claimed_rows(self.job_name)
+        self.merge_worker_summaries(worker_summaries, failed_line_nums)
+        self.report.print_summary()
+        for key_name, remaining_count in self.credential_pool.get_remaining_quota().items():
+            print(f'   {key_name}: {remaining_count} aladin calls left today')
+        self.report.save()
+
+    def sync_notion_indexes(self, profile_names):
+        # synced once here, so the workers only fetch the few pages edited since
+        scheduler = build_default_scheduler(1)
+        for profile_name in profile_names:
+            if profile_name not in PROFILES:
+                continue
+            notion = Notion(database_id=PROFILES[profile_name].database_id)
+            # same integration as the first worker, not the default token that might not see the database
+            notion.authorization_key = self.credential_pool.notion_tokens[0]['authorization_key']
+            notion_index = NotionIndex(notion, scheduler=scheduler)
+            try:
+                print(f'{notion_index.sync()} pages synced from your notion ({profile_name})')
+            except Exception:
+                print(f'Couldn\'t sync with your notion ({profile_name}). Each worker tries again.')
+
+    def run_workers(self, processes, available_keys):
+        # keys and tokens go round robin. a token (or key) shared by k processes gives each of them 1/k of its rate
+        notion_tokens = self.credential_pool.notion_tokens
+        aladin_sharers = [available_keys[i % len(available_keys)]['name'] for i in range(processes)]
+        notion_sharers = [notion_tokens[i % len(notion_tokens)]['name'] for i in range(processes)]
+        # spawn, so a worker doesn't inherit sqlite connections and locks of this process
+        with ProcessPoolExecutor(processes, mp_context=get_context('spawn')) as executor:
+            futures = []
+            for shard in range(processes):
+                aladin_key = available_keys[shard % len(available_keys)]
+                notion_token = notion_tokens[shard % len(notion_tokens)]
+                futures.append(executor.submit(
+                    run_shard_worker, self.job_name, shard, self.credentials_path, aladin_key['name'],
+                    aladin_key['rate_per_sec'] / aladin_sharers.count(aladin_key['name']), notion_token['name'],
+                    notion_token['rate_per_sec'] / notion_sharers.count(notion_token['name']), self.threads,
+                    self.options))
+            while True:
+                done, not_done = wait(futures, timeout=5)
+                self.print_progress()
+                if not not_done:
+                    break
+        worker_summaries = []
+        for shard, future in enumerate(futures):
+            try:
+                worker_summaries.append(future.result())
+            except Exception as e:
+                # the other workers' rows and the report are kept
+                print(f'shard {shard} stopped by {e!r}')
+        return worker_summaries
+
+    def print_progress(self):
+        counts = self.work_table.get_status_counts(self.job_name)
+        remaining_quota = sum(self.credential_pool.get_remaining_quota().values())
+        print(f'{counts.get("done", 0)} / {sum(counts.values())} rows done, {counts.get("claimed", 0)} in progress '
+              f'({remaining_quota} aladin calls left today)')
+
+    def merge_worker_summaries(self, worker_summaries, failed_line_nums=()):
+        for line_num, target, status, result in self.work_table.get_rows(self.job_name):
+            if status == 'done':
+                self.report.add_result(line_num, target, result)
+            elif line_num in failed_line_nums:
+                self.report.add_result(line_num, target, 'worker_failed')
+            else:
+                # rows left pending found every key used up. --resume takes them tomorrow
+                self.report.add_result(line_num, target, 'quota_exceeded')
+        cache_stats = {}
+        for worker_summary in worker_summaries:
+            self.report.retry_count += worker_summary['retry_count']
+            for counts, worker_counts in ((cache_stats, worker_summary['cache_stats']),
+                                          (self.report.page_update_counts, worker_summary['page_update_counts']),
+                                          (self.report.queue_counts, worker_summary['queue_counts'])):
+                for key, count in worker_counts.items():
+                    counts[key] = counts.get(key, 0) + count
+            self.report.stage_timings += [dict(stage_timing, shard=worker_summary['shard'])
+                                          for stage_timing in worker_summary['stage_timings']]
+        self.report.cache_stats = cache_stats
+
+
+class ShardWorker(BulkBookRecord):
+    # one process of a sharded import. everything but where rows come from and go to is bulk_import as it is
+    def __init__(self, job_name, shard, credential_pool, aladin_bucket, scheduler, options):
+        self.shard_job_name = job_name
+        self.shard = shard
+        self.credential_pool = credential_pool
+        self.aladin_bucket = aladin_bucket
+        self.work_table = WorkTable()
+        self.out_of_quota = False
+        self.key_lock = threading.Lock()
+        chooser = CHOOSERS[options.get('choose', 'rank')]
+        if chooser is choose_by_rank:
+            chooser = partial(choose_by_rank, min_confidence=options.get('min_confidence', 0.75))
+        # the post queue keeps its own record of this worker, apart from bulk_import runs of the same file
+        super().__init__(f'{job_name}#{shard}', chooser, scheduler.max_workers, options.get('use_cache', True),
+                         options.get('skip_duplicates', True), scheduler,
+                         PROFILES[options.get('default_profile', BOOK_PROFILE.name)], options.get('upsert', False))
+
+    def execute_bulk_book_record(self, file_path):
+        self.aladin.ttb_key = self.credential_pool.get_aladin_key(self.aladin_bucket.key_name)['ttb_key']
+        self.get_engine(self.default_profile.name)
+        results = self.scheduler.map_unordered(self.record_target_book, self.claim_rows())
+        for line_num, target, result in results:
+            if result == 'quota_exceeded':
+                # another worker with calls left takes it, or the next run
+                self.work_table.release_row(self.shard_job_name, line_num)
+            else:
+                self.work_table.finish_row(self.shard_job_name, line_num, result)
+        self.flush_page_updates()
+        self.report.queue_counts = drain_post_queue(self.post_queue, self.get_engine, self.scheduler)
+        self.report.retry_count = self.scheduler.retry_count
+        self.report.cache_stats = dict(self.aladin.cache.get_stats(), search_index_hits=self.search_index_hit_count)
+
+    def claim_rows(self):
+        while not self.out_of_quota:
+            rows = self.work_table.claim_rows(self.shard_job_name, self.shard, self.scheduler.max_workers)
+            if not rows:
+                return
+            yield from rows
+
+    def record_target_book(self, line_target):
+        # the key is the same in every run of the job, so a row posted before a crash isn't posted again
+        line_num, target = line_target
+        while True:
+            key_name = self.aladin_bucket.key_name
+            result = self.resolve_and_post_target_book(target, f'{self.shard_job_name}:{line_num}')
+            if result != 'quota_exceeded' or not self.switch_aladin_key(key_name):
+                return line_num, target, result
+
+    def switch_aladin_key(self, used_up_key_name):
+        # True when there's another key to go on with
+        with self.key_lock:
+            if self.out_of_quota:
+                return False
+            if self.aladin_bucket.key_name != used_up_key_name:
+                # another thread already switched
+                return True
+            aladin_key = self.credential_pool.lease_aladin_key()
+            if aladin_key is None:
+                self.out_of_quota = True
+                return False
+            self.aladin.ttb_key = aladin_key['ttb_key']
+            self.aladin_bucket.key_name = aladin_key['name']
+            print(f'shard {self.shard}: {used_up_key_name} is used up, going on with {aladin_key["name"]}')
+            return True
+
+    def get_summary(self):
+        return {'shard': self.shard,
+                'retry_count': self.report.retry_count,
+                'cache_stats': self.report.cache_stats,
+                'page_update_counts': self.report.page_update_counts,
+                'queue_counts': self.report.queue_counts,
+                'stage_timings': tracer.metrics.to_dict()['histograms']}
+
+
+class WorkTable:
+    # rows of sharded import jobs, shared by the coordinator and every worker process.
+    # status is 'pending', 'claimed'(a worker has it) or 'done'
+    def __init__(self, db_path=DEFAULT_WORK_TABLE_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_job ('
+                                'job_name TEXT PRIMARY KEY, file_path TEXT NOT NULL, shard_count INTEGER NOT NULL, '
+                                'started_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shard_row ('
+                                'job_name TEXT NOT NULL, line_num INTEGER NOT NULL, target TEXT NOT NULL, '
+                                'shard INTEGER NOT NULL, status TEXT NOT NULL, result TEXT, '
+                                'PRIMARY KEY (job_name, line_num))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS shard_row_status ON shard_row (job_name, status, shard)')
+
+    def start_job(self, file_path, shard_count, resume=False):
+        # (job name, True when it's new). resume goes on with the latest job of the file: rows a dead worker
+        # had claimed and rows worth trying again are pending again
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            if resume:
+                row = self.connection.execute('SELECT job_name FROM shard_job WHERE file_path = ? '
+                                              'ORDER BY started_at DESC LIMIT 1', (file_path,)).fetchone()
+                if row is not None:
+                    self.connection.execute('BEGIN IMMEDIATE')
+                    self.connection.execute("UPDATE shard_row SET status = 'pending' WHERE job_name = ? AND "
+                                            "status = 'claimed'", (row[0],))
+                    placeholders = ', '.join('?' * len(RETRYABLE_RESULTS))
+                    self.connection.execute(f"UPDATE shard_row SET status = 'pending', result = NULL "
+                                            f"WHERE job_name = ? AND result IN ({placeholders})",
+                                            (row[0],) + RETRYABLE_RESULTS)
+                    self.connection.execute('COMMIT')
+                    return row[0], False
+            started_at = time.time()
+            job_name = f'{file_path}@{started_at:.6f}'
+            self.connection.execute('INSERT INTO shard_job VALUES (?, ?, ?, ?)',
+                                    (job_name, file_path, shard_count, started_at))
+        return job_name, True
+
+    def add_rows(self, job_name, target_book_list, shard_count, default_profile_name, skip_duplicates=True):
+        # rows round robin over the shards. a row asking for the same book as an earlier one is done right away
+        # as a duplicate, since two processes could otherwise both post it. returns the profile names seen
+        seen_keys, profile_names = set(), set()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            for line_num, target in target_book_list:
+                profile_name = target['profile'] or default_profile_name
+                profile_names.add(profile_name)
+                book_key = (profile_name, target['isbn'] or normalize_title(target['title']))
+                is_duplicate = skip_duplicates and book_key in seen_keys
+                status, result = ('done', 'duplicate') if is_duplicate else ('pending', None)
+                seen_keys.add(book_key)
+                self.connection.execute('INSERT INTO shard_row VALUES (?, ?, ?, ?, ?, ?)',
+                                        (job_name, line_num, json.dumps(target, ensure_ascii=False),
+                                         line_num % shard_count, status, result))
+            self.connection.execute('COMMIT')
+        return profile_names
+
+    def claim_rows(self, job_name, shard, limit):
+        # [(line number, target), ...] of its own shard first, then of any other
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            rows = self.connection.execute("SELECT line_num, target FROM shard_row WHERE job_name = ? AND "
+                                           "status = 'pending' ORDER BY shard != ?, line_num LIMIT ?",
+                                           (job_name, shard, limit)).fetchall()
+            self.connection.executemany("UPDATE shard_row SET status = 'claimed' WHERE job_name = ? AND line_num = ?",
+                                        [(job_name, line_num) for line_num, _ in rows])
+            self.connection.execute('COMMIT')
+        return [(line_num, json.loads(target)) for line_num, target in rows]
+
+    def finish_row(self, job_name, line_num, result):
+        with self.lock:
+            self.connection.execute("UPDATE shard_row SET status = 'done', result = ? WHERE job_name = ? AND "
+                                    "line_num = ?", (result, job_name, line_num))
+
+    def release_row(self, job_name, line_num):
+        with self.lock:
+            self.connection.execute("UPDATE shard_row SET status = 'pending' WHERE job_name = ? AND line_num = ?",
+                                    (job_name, line_num))
+
+    def release_claimed_rows(self, job_name):
+        # returns the line numbers set back to pending
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            rows = self.connection.execute("SELECT line_num FROM shard_row WHERE job_name = ? AND status = 'claimed'",
+                                           (job_name,)).fetchall()
+            self.connection.execute("UPDATE shard_row SET status = 'pending' WHERE job_name = ? AND status = 'claimed'",
+                                    (job_name,))
+            self.connection.execute('COMMIT')
+        return {line_num for line_num, in rows}
+
+    def get_status_counts(self, job_name):
+        with self.lock:
+            return dict(self.connection.execute('SELECT status, COUNT(*) FROM shard_row WHERE job_name = ? '
+                                                'GROUP BY status', (job_name,)))
+
+    def get_rows(self, job_name):
+        with self.lock:
+            rows = self.connection.execute('SELECT line_num, target, status, result FROM shard_row '
+                                           'WHERE job_name = ? ORDER BY line_num', (job_name,)).fetchall()
+        return [(line_num, json.loads(target), status, result) for line_num, target, status, result in rows]
+
+
+def run_shard_worker(job_name, shard, credentials_path, aladin_key_name, aladin_rate_per_sec, notion_token_name,
+                     notion_rate_per_sec, threads, options):
+    # runs in a process of its own. every notion client of the process uses the token of this worker
+    credential_pool = CredentialPool(credentials_path)
+    os.environ['NOTION_AUTHORIZATION_KEY'] = credential_pool.get_notion_token(notion_token_name)['authorization_key']
+    scheduler = RateLimitedScheduler(threads)
+    scheduler.add_backend('notion', TokenBucket(rate_per_sec=notion_rate_per_sec))
+    aladin_bucket = PooledQuotaBucket(credential_pool, aladin_key_name, aladin_rate_per_sec)
+    scheduler.add_backend('aladin', aladin_bucket)
+    shard_worker = ShardWorker(job_name, shard, credential_pool, aladin_bucket, scheduler, options)
+    return shard_worker.get_summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bulk_import over several processes and api credentials')
+    parser.add_argument('file_path', help='csv(title, isbn, profile columns) or jsonl file')
+    parser.add_argument('--credentials', default=DEFAULT_CREDENTIALS_PATH, help='json file of aladin keys and '
+                                                                                'notion tokens')
+    parser.add_argument('--processes', type=int, help='default is one per aladin key with calls left today')
+    parser.add_argument('--threads', type=int, default=4, help='books handled at once in each process')
+    parser.add_argument('--resume', action='store_true', help='go on with the last run of this file')
+    parser.add_argument('--profile', choices=PROFILES.keys(), default=BOOK_PROFILE.name,
+                        help='target database of rows without profile')
+    parser.add_argument('--choose', choices=CHOOSERS.keys(), default='rank', help='how to pick a candidate')
+    parser.add_argument('--min-confidence', type=float, default=0.75)
+    parser.add_argument('--no-cache', action='store_true', help='always ask aladin, not the local cache')
+    parser.add_argument('--allow-duplicates', action='store_true', help='add books already in your notion again')
+    parser.add_argument('--upsert', action='store_true', help='update changed properties of books already there')
+    args = parser.parse_args()
+
+    My_Sharded_Bulk_Import = ShardedBulkImport(args.file_path, args.credentials, args.processes, args.threads,
+                                               args.resume,
+                                               {'default_profile': args.profile, 'choose': args.choose,
+                                                'min_confidence': args.min_confidence, 'use_cache': not args.no_cache,
+                                                'skip_duplicates': not args.allow_duplicates, 'upsert': args.upsert})
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import queue
+import threading
+import selectors
+
+from tracing import tracer
+
+
+class StdinLineReader:
+    # reads stdin in the same process. bytes after the first newline are kept for the next prompt
+    def __init__(self):
+        self.pending = b''
+        self.eof = False
+        self.fallback_lines = None
+
+    def readline(self, timeout_sec):
+        if os.name == 'nt' or not hasattr(sys.stdin, 'fileno'):
+            # select() only takes sockets on windows
+            return self.readline_w_thread(timeout_sec)
+
+        fd = sys.stdin.fileno()
+        deadline = time.monotonic() + timeout_sec
+        with selectors.SelectSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while b'\n' not in self.pending and not self.eof:
+                remaining_sec = deadline - time.monotonic()
+                if remaining_sec <= 0 or not selector.select(remaining_sec):
+                    raise TimeoutError
+                chunk = os.read(fd, 4096)
+                if chunk:
+                    self.pending += chunk
+                else:
+                    self.eof = True
+
+        if self.eof and not self.pending:
+            # same as builtin input() when stdin is closed
+            raise EOFError
+        line, _, self.pending = self.pending.partition(b'\n')
+        return line.decode('UTF-8', errors='replace').strip("\r\n")
+
+    def readline_w_thread(self, timeout_sec):
+        if self.fallback_lines is None:
+            # one reader thread for the whole program, not one per prompt
+            self.fallback_lines = queue.Queue()
+            threading.Thread(target=self.read_stdin_forever, daemon=True).start()
+        if self.eof and self.fallback_lines.empty():
+            raise EOFError
+        try:
+            line = self.fallback_lines.get(timeout=timeout_sec)
+        except queue.Empty:
+            raise TimeoutError
+        if line is None:
+            raise EOFError
+        return line
+
+    def read_stdin_forever(self):
+        for line in sys.stdin:
+            self.fallback_lines.put(line.strip("\r\n"))
+        # one None wakes a prompt already waiting. later prompts see eof and don't wait at all
+        self.eof = True
+        self.fallback_lines.put(None)
+
+    def flush(self):
+        # when some keys hit and timeout occurred before enter key press,
+        # that input text passed to next input(). remove stdin buffer.
+        self.pending = b''
+        try:
+            import termios
+        except ImportError:
+            # windows, just exit
+            return
+        try:
+            termios.tcflush(sys.stdin, termios.TCIFLUSH)
+        except termios.error:
+            # stdin is not a terminal
+            pass
+
+
+stdin_line_reader = StdinLineReader()
+
+
+def input_timer(prompt, timeout_sec):
+    # print prompt immediately with no new line
+    print(prompt, end="")
+    sys.stdout.flush()
+
+    try:
+        with tracer.span('user_input'):
+            return stdin_line_reader.readline(timeout_sec)
+    except TimeoutError:
+        stdin_line_reader.flush()
+        # move the cursor to next line
+        print("")
+        raise
+
+
+def input_w_timeout(str_to_print, timeout_sec=600, quit=True):
+    try:
+        title = input_timer(str_to_print, timeout_sec)
+        return title
+    except TimeoutError:
+        print(f"\nno input for {timeout_sec / 60:.0f} minutes. program exited.")
+        if quit:
+            sys.exit()
+        else:
+            pass
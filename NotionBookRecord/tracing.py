@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+from contextlib import contextmanager
+
+# seconds. wide enough for a parse of a few microseconds and a notion post retried after 429
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = 'book_record_'
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = 'ok'
+        self.started_at = time.time()
+        self.duration_sec = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self):
+        return dict(self.attributes, trace_id=self.trace_id, span_id=self.span_id, parent_id=self.parent_id,
+                    name=self.name, started_at=round(self.started_at, 6),
+                    duration_ms=round(self.duration_sec * 1000, 3), status=self.status)
+
+
+class Metrics:
+    # counters and fixed bucket histograms, labelled like prometheus. memory only grows with label combinations
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        # (name, labels) -> [count per bucket(+inf last), sum, count]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            bucket_index = len(self.buckets)
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_index = i
+                    break
+            histogram[0][bucket_index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get_quantile(self, bucket_counts, total_count, quantile):
+        # linear within the bucket, same as prometheus histogram_quantile
+        rank = quantile * total_count
+        seen_count, lower_bound = 0, 0.0
+        for upper_bound, bucket_count in zip(self.buckets + (self.buckets[-1],), bucket_counts):
+            if bucket_count and seen_count + bucket_count >= rank:
+                return lower_bound + (upper_bound - lower_bound) * (rank - seen_count) / bucket_count
+            seen_count += bucket_count
+            lower_bound = upper_bound
+        return lower_bound
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in self.histograms.items())
+
+        typed_names = set()
+        for (name, labels), value in counters:
+            metric_name = METRIC_PREFIX + name
+            if metric_name not in typed_names:
+                lines.append(f'# TYPE {metric_name} counter')
+                typed_names.add(metric_name)
+            lines.append(f'{metric_name}{format_labels(labels)} {value}')
+        for (name, labels), (bucket_counts, total_sec, total_count) in histograms:
+            metric_name = METRIC_PREFIX + name
+            if metric_name not in typed_names:
+                lines.append(f'# TYPE {metric_name} histogram')
+                typed_names.add(metric_name)
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(f'{metric_name}_bucket{format_labels(labels + (("le", upper_bound),))} {cumulative_count}')
+            lines.append(f'{metric_name}_sum{format_labels(labels)} {total_sec}')
+            lines.append(f'{metric_name}_count{format_labels(labels)} {total_count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        with self.lock:
+            counters = [dict(labels, name=name, value=value) for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), (bucket_counts, total_sec, total_count) in sorted(self.histograms.items()):
+                histograms.append(dict(labels, name=name, count=total_count,
+                                       avg_ms=round(total_sec / total_count * 1000, 3),
+                                       p50_ms=round(self.get_quantile(bucket_counts, total_count, 0.5) * 1000, 3),
+                                       p99_ms=round(self.get_quantile(bucket_counts, total_count, 0.99) * 1000, 3)))
+        return {'counters': counters, 'histograms': histograms}
+
+
+class Tracer:
+    # spans nest per thread. every finished span is a sample of stage_duration_seconds{stage=name},
+    # and with a span log path it is also written as one json line
+    def __init__(self, span_log_path=None):
+        self.metrics = Metrics()
+        self.local = threading.local()
+        self.span_log = None
+        self.span_log_lock = threading.Lock()
+        if span_log_path:
+            self.span_log = open(span_log_path, 'a', encoding='utf8', buffering=1)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = self.get_span_stack()
+        parent = stack[-1] if stack else None
+        span = Span(name, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None,
+                    attributes)
+        stack.append(span)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.status = 'error'
+            raise
+        finally:
+            span.duration_sec = time.perf_counter() - started_at
+            stack.pop()
+            self.finish_span(span)
+
+    def get_span_stack(self):
+        if not hasattr(self.local, 'span_stack'):
+            self.local.span_stack = []
+        return self.local.span_stack
+
+    def get_current_span(self):
+        stack = self.get_span_stack()
+        return stack[-1] if stack else None
+
+    def finish_span(self, span):
+        self.metrics.observe('stage_duration_seconds', span.duration_sec, stage=span.name)
+        if span.status == 'error':
+            self.metrics.count('stage_errors_total', stage=span.name)
+        if self.span_log is not None:
+            line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+            with self.span_log_lock:
+                self.span_log.write(line + '\n')
+
+    def record_http_response(self, span, backend, method, response, request_bytes):
+        response_bytes = len(response.content)
+        span.set(status_code=response.status_code, request_bytes=request_bytes, response_bytes=response_bytes)
+        self.metrics.count('http_requests_total', backend=backend, method=method, status=str(response.status_code))
+        self.metrics.count('http_request_bytes_total', request_bytes, backend=backend)
+        self.metrics.count('http_response_bytes_total', response_bytes, backend=backend)
+
+    def record_retry(self, backend, reason):
+        self.metrics.count('http_retries_total', backend=backend, reason=reason)
+        current_span = self.get_current_span()
+        if current_span is not None:
+            current_span.add('retries')
+
+    def export(self):
+        # prometheus text for a node_exporter textfile collector, written at the end of a script
+        metrics_path = os.environ.get('BOOK_RECORD_METRICS_PATH')
+        if not metrics_path:
+            return
+        temp_path = f'{metrics_path}.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            f.write(self.metrics.render_prometheus())
+        os.replace(temp_path, metrics_path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped_labels = (f'{key}="{escape_label_value(value)}"' for key, value in labels)
+    return '{' + ','.join(escaped_labels) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def summarize_span_log(path):
+    # {span name: {count, p50_ms, p99_ms, max_ms, errors}} from the exact durations of a json span log
+    durations_by_name, errors_by_name = {}, {}
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            span = json.loads(line)
+            durations_by_name.setdefault(span['name'], []).append(span['duration_ms'])
+            if span['status'] == 'error':
+                errors_by_name[span['name']] = errors_by_name.get(span['name'], 0) + 1
+
+    summary = {}
+    for name, durations in sorted(durations_by_name.items()):
+        durations.sort()
+        summary[name] = {'count': len(durations),
+                         'p50_ms': durations[int(0.5 * (len(durations) - 1))],
+                         'p99_ms': durations[int(0.99 * (len(durations) - 1))],
+                         'max_ms': durations[-1],
+                         'errors': errors_by_name.get(name, 0)}
+    return summary
+
+
+# one tracer for the whole program. BOOK_RECORD_TRACE_LOG=path turns on the json span log
+tracer = Tracer(os.environ.get('BOOK_RECORD_TRACE_LOG'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='p50/p99 per stage from a json span log')
+    parser.add_argument('span_log_path')
+    args = parser.parse_args()
+
+    print(f'{"stage":<32} {"count":>8} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10} {"errors":>7}')
+    for name, stage_summary in summarize_span_log(args.span_log_path).items():
+        print(f'{name:<32} {stage_summary["count"]:>8} {stage_summary["p50_ms"]:>10.3f} '
+              f'{stage_summary["p99_ms"]:>10.3f} {stage_summary["max_ms"]:>10.3f} {stage_summary["errors"]:>7}')